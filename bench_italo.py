@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import statistics
+import contextlib
+import subprocess
+import collections
+import urllib.parse
+
+import requests
+
+from italo import TrainManager, SessionPool, GRMCache, SeatAvailability, http_session
+from fake_italo import FakeItalo, build_fixtures
+
+# endpoint (last URL path element) -> stage
+STAGES = {"Login": "login", "RicercaTrenoService": "realtime", "ClearSession": "clear_session",
+          "GetAvailableTrains": "availability", "HoldBooking": "hold", "GetSeatAvailability": "seat_map",
+          "GetGRMContent": "grm"}
+
+# train number, equipment, first station and number of stops of the benchmarked trains (see fake_italo.TRAINS)
+SCENARIOS = (("1003", "AGV", 0, 3), ("1008", "AGV", 0, 8), ("2005", "EVO", 3, 5), ("3003", "EVI", 0, 3),
+             ("3008", "EVI", 0, 8))
+
+
+class StageMetrics:
+    """Time, requests and bytes (request payloads plus responses as received) spent in each stage of a scan.
+
+    Times of the network stages add up the requests, that overlap when hops are scanned concurrently.
+    """
+
+    def __init__(self):
+        self.stages = collections.defaultdict(lambda: {"time": 0.0, "requests": 0, "bytes": 0})
+        self._lock = threading.Lock()
+
+    def add(self, stage, elapsed, transferred=0, requests_count=1):
+        with self._lock:
+            self.stages[stage]["time"] += elapsed
+            self.stages[stage]["requests"] += requests_count
+            self.stages[stage]["bytes"] += transferred
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+
+        finally:
+            self.add(stage, time.perf_counter() - started, requests_count=0)
+
+
+class MeteredSession(requests.Session):
+    """requests.Session, tuned like the one of TrainManager, adding every request to the StageMetrics of its endpoint"""
+
+    def __init__(self, metrics):
+        super().__init__()
+        self.metrics = metrics
+        http_session(session=self)
+
+    def request(self, method, url, *args, **kwargs):
+        started = time.perf_counter()
+        response = super().request(method, url, *args, **kwargs)
+        endpoint = urllib.parse.urlsplit(url).path.rstrip("/").split("/")[-1]
+        self.metrics.add(STAGES.get(endpoint, endpoint), time.perf_counter() - started,
+                         len(response.request.body or b"")
+                         + int(response.headers.get("Content-Length", len(response.content))))
+        return response
+
+
+def run_scan(base_url, train_number, concurrency=1, fare_probing=False):
+    """Scan a train from scratch (cold sessions and layout cache) and render its page, measuring every stage"""
+    metrics = StageMetrics()
+    sessions = [MeteredSession(metrics)]
+
+    def spawn_worker():
+        sessions.append(MeteredSession(metrics))
+        return TrainManager(grm_cache=False, session=sessions[-1], base_url=base_url)
+
+    session_pool = SessionPool(spawn_worker, size=concurrency)
+    try:
+        with tempfile.TemporaryDirectory() as grm_path:
+            tm = TrainManager(grm_cache=GRMCache(path=grm_path), session_pool=session_pool, session=sessions[0],
+                              base_url=base_url)
+            started = time.perf_counter()
+            train_schedule = tm.search_train(train_number)
+            hop_results = list(tm.iter_seats(train_schedule, concurrency, fare_probing))
+            availability = SeatAvailability.from_hops(train_schedule, hop_results)
+            grm_map = tm.create_grm_map(availability.equipment_type)
+            with metrics.measure("render"):
+                tm.render_html(availability, grm_map)
+
+            elapsed = time.perf_counter() - started
+
+    finally:
+        session_pool.close()
+        for session in sessions:
+            session.close()
+
+    return {"wall": elapsed,
+            "requests": sum(stage["requests"] for stage in metrics.stages.values()),
+            "bytes": sum(stage["bytes"] for stage in metrics.stages.values()),
+            "hop": statistics.median(hop_result["elapsed"] for hop_result in hop_results),
+            "stages": dict(metrics.stages)}
+
+
+def run_benchmark(concurrency_levels=(1, 4), fare_probing=False, repeat=3, latency=0.02, jitter=0.005, seed=0,
+                  scenarios=SCENARIOS):
+    """Scan every scenario at every concurrency level `repeat` times on a FakeItalo, keeping the median run"""
+    results = []
+    with FakeItalo(build_fixtures(seed=seed, trains=scenarios), latency, jitter, seed=seed) as server:
+        for train_number, train_type, _, stop_count in scenarios:
+            for concurrency in concurrency_levels:
+                runs = sorted((run_scan(server.url, train_number, concurrency, fare_probing) for _ in range(repeat)),
+                              key=lambda run: run["wall"])
+                results.append(dict(runs[len(runs) // 2], train_type=train_type, stops=stop_count,
+                                    concurrency=concurrency, fare_probing=fare_probing))
+
+    return results
+
+
+def request_time(result):
+    """Mean time of the requests of a result, as seen by the client"""
+    network = [stage for name, stage in result["stages"].items() if name != "render"]
+    return sum(stage["time"] for stage in network) / max(1, sum(stage["requests"] for stage in network))
+
+
+def check_request_time(results, latency, jitter, overhead=0.01):
+    """Results whose requests take longer than the stand-in waits (`latency` + `jitter`) plus `overhead` seconds.
+
+    Their stage times don't measure the client but the transport (e.g. TCP stalls on the stand-in connections).
+    """
+    return [result for result in results if request_time(result) > latency + jitter + overhead]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def scenario_key(result):
+    return result["train_type"], result["stops"], result["concurrency"], result["fare_probing"]
+
+
+def load_results(path, revision):
+    """Latest stored result of every scenario benchmarked at `revision` (a prefix is enough)"""
+    results = {}
+    try:
+        with open(path) as file:
+            for line in file:
+                result = json.loads(line)
+                if result["revision"] and result["revision"].startswith(revision):
+                    results[scenario_key(result)] = result
+
+    except OSError:
+        pass
+
+    return results
+
+
+def print_results(results, baseline=None):
+    print("%-4s %5s %4s %9s %9s %9s %5s %9s  %s" % ("type", "stops", "conc", "wall", "hop", "req", "reqs", "bytes",
+                                                    "stages"))
+    for result in results:
+        line = "%-4s %5d %4d %8.3fs %8.3fs %8.3fs %5d %9d  %s" % (
+            result["train_type"], result["stops"], result["concurrency"], result["wall"], result["hop"],
+            request_time(result), result["requests"], result["bytes"],
+            " ".join("%s=%.3fs/%d" % (stage, metrics["time"], metrics["requests"])
+                     for stage, metrics in result["stages"].items()))
+
+        base_result = (baseline or {}).get(scenario_key(result))
+        if base_result:
+            line += "  (wall %+.1f%%, %+d reqs)" % (100 * (result["wall"] / base_result["wall"] - 1),
+                                                   result["requests"] - base_result["requests"])
+
+        print(line)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the seat scans against a local stand-in of Italo")
+    parser.add_argument("-c", "--concurrency", type=int, nargs="+", default=[1, 4], help="hop concurrency levels")
+    parser.add_argument("-p", "--probe-fares", action="store_true", help="hold one fare per cabin class")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="runs of every scenario (the median is kept)")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds waited by every request")
+    parser.add_argument("--jitter", type=float, default=0.005, help="random ± seconds added to the latency")
+    parser.add_argument("-o", "--output", default="bench_results.jsonl",
+                        help="JSON lines file the results are appended to (default: bench_results.jsonl)")
+    parser.add_argument("--compare", metavar="REVISION", help="compare with the results stored for a git revision")
+    args = parser.parse_args()
+
+    revision = git_revision()
+    results = run_benchmark(args.concurrency, args.probe_fares, args.repeat, args.latency, args.jitter)
+    print_results(results, load_results(args.output, args.compare) if args.compare else None)
+
+    with open(args.output, "a") as output_file:
+        for result in results:
+            output_file.write(json.dumps(dict(result, revision=revision, time=time.time(),
+                                              latency=args.latency, jitter=args.jitter)) + "\n")
+
+    print("DONE:", output_file.name)
+
+    slow_results = check_request_time(results, args.latency, args.jitter)
+    if slow_results:
+        print("WARNING: requests take up to %.3fs, the stand-in waits %.3fs ± %.3fs: the stage times measure the "
+              "transport, not the client" % (max(map(request_time, slow_results)), args.latency, args.jitter))
+        raise SystemExit(1)
@@ -0,0 +1,330 @@
+import gzip
+import json
+import time
+import random
+import hashlib
+import datetime
+import threading
+import collections
+import http.server
+import urllib.parse
+
+from italo import train_mapping
+
+# cabin class of every compartment: fares of a class open the seats of its compartments only
+COMPARTMENT_CLASSES = {
+    "AGV": {"1": "C", "2": "P", "3": "P"},
+    "EVO": {"1": "C", "2": "P"},
+    "EVI": {"1A": "C", "2A": "P", "1B": "C", "2B": "P"}
+}
+
+PRODUCT_NAMES = {"C": "Club Executive", "P": "Prima", "S": "Smart"}
+
+STATIONS = [("MC_", "Milano Centrale"), ("MRO", "Milano Rogoredo"), ("BO2", "Bologna Centrale"),
+            ("SMN", "Firenze S. M. Novella"), ("RMT", "Roma Termini"), ("RTB", "Roma Tiburtina"),
+            ("NAC", "Napoli Centrale"), ("SAL", "Salerno")]
+
+# train number, equipment, first station and number of stops (in STATIONS)
+TRAINS = (("8918", "AGV", 0, 7), ("9921", "EVO", 3, 5), ("8158", "EVI", 0, 5))
+
+# answers larger than this (bytes) are gzipped for the clients accepting it, like the real endpoints do
+GZIP_MIN_SIZE = 1024
+
+
+def _seat_ids(train_type, rows=4):
+    return ["%s_%d%s" % (compartment, row, column)
+            for compartment in train_mapping[train_type] for row in range(1, rows + 1) for column in "ABCD"]
+
+
+def build_fixtures(departure=None, seed=0, trains=TRAINS):
+    """Fixtures of the `trains` (by default an AGV, an EVO and an EVI one), the same ones for the same `seed`.
+
+    Trains leave their first stop at `departure` ("HH:MM", half an hour from now by default) and take 40 minutes per
+    hop. AGV trains also have a fare answering HoldBooking with Code 1004 and a sold out one (Code 1513).
+    """
+    departure = datetime.datetime.combine(
+        datetime.date.today(), datetime.time.fromisoformat(departure)
+    ) if departure else datetime.datetime.now().replace(second=0, microsecond=0) + datetime.timedelta(minutes=30)
+
+    fixtures = {"trains": {}, "grm": {}}
+    for train_number, train_type, first_station, stop_count in trains:
+        generator = random.Random("%s-%s" % (seed, train_number))
+        stops = []
+        for index, (location_code, location_description) in enumerate(
+                STATIONS[first_station:first_station + stop_count]):
+            stop_time = (departure + datetime.timedelta(minutes=40 * index)).strftime("%H:%M")
+            stops.append({"LocationCode": location_code, "LocationDescription": location_description,
+                          "EstimatedArrivalTime": stop_time, "ActualArrivalTime": stop_time,
+                          "ActualDepartureTime": stop_time})
+
+        seats = _seat_ids(train_type)
+        fares = [{"FareSellKey": "%s~%s~%d" % (train_number, product_class, index), "ProductClass": product_class}
+                 for index, product_class in enumerate(("S", "S", "P", "C"))]
+        if train_type == "AGV":
+            fares[1]["Code"] = 1004
+            fares.append({"FareSellKey": "%s~P~%d" % (train_number, len(fares)), "ProductClass": "P", "Code": 1513})
+
+        fixtures["trains"][train_number] = {
+            "equipment_type": train_type,
+            "schedule": {"TrainNumber": train_number,
+                         "DepartureStationDescription": stops[0]["LocationDescription"],
+                         "DepartureDate": stops[0]["EstimatedArrivalTime"],
+                         "ArrivalStationDescription": stops[-1]["LocationDescription"],
+                         "ArrivalDate": stops[-1]["EstimatedArrivalTime"],
+                         "StazioniNonFerme": stops},
+            "fares": fares,
+            "hops": [sorted(generator.sample(seats, len(seats) * 2 // 5)) for _ in stops[1:]]
+        }
+
+    for train_type, compartments in train_mapping.items():
+        for compartment_number, grm_id in compartments.items():
+            # the first compartment using a layout names it (EVI compartments share the EVO ones)
+            fixtures["grm"].setdefault(str(grm_id), _grm_svg(compartment_number))
+
+    return fixtures
+
+
+def _grm_svg(compartment_number, rows=4):
+    seats = "".join("<a class=\"seat\" href=\"%d%s\"><rect x=\"%d\" y=\"%d\" width=\"40\" height=\"40\"/>"
+                    "<text x=\"%d\" y=\"%d\">%d%s</text></a>" % (row, column, 50 * row, 50 * offset,
+                                                                 50 * row + 8, 50 * offset + 25, row, column)
+                    for row in range(1, rows + 1) for offset, column in enumerate("ABCD"))
+    return "<svg xmlns=\"http://www.w3.org/2000/svg\" data-name=\"coach_%s\" viewBox=\"0 0 %d 200\">%s" \
+           "<g data-name=\"not_available\"/></svg>" % (compartment_number, 50 * (rows + 1), seats)
+
+
+class FakeItalo:
+    """Local stand-in for the realtime and booking endpoints of Italo, answering from `fixtures` (see build_fixtures).
+
+    Every request waits `latency` ± `jitter` seconds and fails with HTTP 503 with probability `unavailable_rate`; a
+    signature expires (Code 1033) after `expire_after` requests. Point TrainManager(base_url=server.url) to it; `calls`
+    counts the requests by endpoint.
+    """
+
+    def __init__(self, fixtures=None, latency=0.0, jitter=0.0, expire_after=None, seed=0, host="127.0.0.1", port=0,
+                 unavailable_rate=0.0):
+        self.fixtures = fixtures or build_fixtures(seed=seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.expire_after = expire_after
+        self.unavailable_rate = unavailable_rate
+        self.calls = collections.Counter()
+
+        self._random = random.Random(seed)
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self._server.server_address[:2]
+
+    def _handler(self):
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body go out as two sends: without TCP_NODELAY, Nagle and the client's delayed ACK hold
+            # the body ~40 ms on keep-alive connections
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                self._reply(fake.handle(url.path, dict(urllib.parse.parse_qsl(url.query))))
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                self._reply(fake.handle(self.path, payload))
+
+            def _reply(self, response):
+                status, body = response
+                body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                if len(body) > GZIP_MIN_SIZE and "gzip" in self.headers.get("Accept-Encoding", ""):
+                    body = gzip.compress(body, compresslevel=6)
+                    self.send_header("Content-Encoding", "gzip")
+
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up waiting (e.g. its timeout is shorter than the latency)
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def handle(self, path, payload):
+        endpoint = path.rstrip("/").split("/")[-1]
+        with self._lock:
+            self.calls[endpoint] += 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            is_unavailable = self._random.random() < self.unavailable_rate
+
+        time.sleep(delay)
+        handler = getattr(self, "_" + endpoint, None)
+        if not handler:
+            return 404, {"Message": "Unknown endpoint %s" % endpoint}
+
+        elif is_unavailable:
+            return 503, {"Message": "Service unavailable"}
+
+        if endpoint not in ("RicercaTrenoService", "Login", "GetGRMContent"):
+            with self._lock:
+                session = self._sessions.get(payload.get("Signature"))
+                if session is None or (self.expire_after and session["requests"] >= self.expire_after):
+                    return 200, {"Code": 1033, "Message": "Invalid session"}
+
+                session["requests"] += 1
+
+            return 200, handler(payload, session)
+
+        return 200, handler(payload)
+
+    def _RicercaTrenoService(self, query):
+        train = self.fixtures["trains"].get(query.get("TrainNumber"))
+        return {"IsEmpty": train is None, "TrainSchedule": train["schedule"] if train else None}
+
+    def _Login(self, payload):
+        with self._lock:
+            signature = "%032x" % self._random.getrandbits(128)
+            self._sessions[signature] = {"requests": 0, "hold": None}
+
+        return {"Signature": signature}
+
+    def _ClearSession(self, payload, session):
+        session["hold"] = None
+        return {}
+
+    @staticmethod
+    def _journey_sell_key(train_number, departure_station, arrival_station):
+        return "IT~%s~ ~~%s~%s~" % (train_number, departure_station, arrival_station)
+
+    def _route(self, journey_sell_key):
+        _, train_number, _, _, departure_station, arrival_station, _ = journey_sell_key.split("~")
+        train = self.fixtures["trains"][train_number]
+        location_codes = [stop["LocationCode"] for stop in train["schedule"]["StazioniNonFerme"]]
+        return train, range(location_codes.index(departure_station), location_codes.index(arrival_station))
+
+    def _GetAvailableTrains(self, payload, session):
+        # the booking endpoints name Bologna BC_, the realtime one BO2
+        departure_station = payload["GetAvailableTrains"]["DepartureStation"].replace("BC_", "BO2")
+        arrival_station = payload["GetAvailableTrains"]["ArrivalStation"].replace("BC_", "BO2")
+
+        journeys = []
+        for train_number, train in self.fixtures["trains"].items():
+            location_codes = [stop["LocationCode"] for stop in train["schedule"]["StazioniNonFerme"]]
+            if departure_station in location_codes and arrival_station in location_codes \
+                    and location_codes.index(departure_station) < location_codes.index(arrival_station):
+                journeys.append({
+                    "JourneySellKey": self._journey_sell_key(train_number, departure_station, arrival_station),
+                    "Segments": [{"Fares": [{"FareSellKey": fare["FareSellKey"],
+                                             "ProductClass": fare["ProductClass"],
+                                             "ProductName": PRODUCT_NAMES[fare["ProductClass"]]}
+                                            for fare in train["fares"]]}]})
+
+        return {"JourneyDateMarkets": [{"Journeys": journeys}]}
+
+    def _HoldBooking(self, payload, session):
+        journey = payload["Journeys"][0]
+        train, _ = self._route(journey["JourneySellKey"])
+        fare = next((fare for fare in train["fares"] if fare["FareSellKey"] == journey["FareSellKey"]), None)
+        if fare is None:
+            return {"Code": 1004, "Message": "Fare not available"}
+
+        elif "Code" in fare:
+            return {"Code": fare["Code"], "Message": "Fare not available"}
+
+        session["hold"] = (journey["JourneySellKey"], fare["ProductClass"])
+        return {"Booking": {"RecordLocator": None, "CurrencyCode": "EUR"}}
+
+    def _GetSeatAvailability(self, payload, session):
+        journey_sell_key = payload["Segment"]["SegmentSellKey"]
+        if not session["hold"] or session["hold"][0] != journey_sell_key:
+            return {"Code": 1513, "Message": "No booking held"}
+
+        train, hops = self._route(journey_sell_key)
+        free_seats = set.intersection(*(set(train["hops"][hop]) for hop in hops))
+        compartment_classes = COMPARTMENT_CLASSES[train["equipment_type"]]
+
+        compartments = []
+        for compartment in train_mapping[train["equipment_type"]]:
+            is_held = compartment_classes.get(compartment, "S") == session["hold"][1]
+            compartments.append({"CompartmentDesignator": compartment, "Seats": [
+                {"SeatDesignator": seat_id.split("_")[1], "Assignable": True,
+                 "SeatAvailability": 5 if is_held and seat_id in free_seats else 3}
+                for seat_id in _seat_ids(train["equipment_type"]) if seat_id.split("_")[0] == compartment]})
+
+        return {"Equipment": {"EquipmentType": train["equipment_type"], "Compartments": compartments}}
+
+    def _GetGRMContent(self, payload):
+        data = self.fixtures["grm"].get(str(payload["ContentID"]))
+        if data is None:
+            return {"Code": 1004, "Message": "Content not found"}
+
+        checksum = hashlib.md5(data.encode()).hexdigest()
+        if payload.get("MD5checksum") == checksum:
+            return {"Data": None, "MD5checksum": checksum}
+
+        return {"Data": list(data.encode()), "MD5checksum": checksum}
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        if self._thread:
+            self._server.shutdown()
+
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Local stand-in for the Italo endpoints, answering from fixtures")
+    parser.add_argument("-p", "--port", type=int, default=8000)
+    parser.add_argument("-f", "--fixtures", help="JSON fixtures to serve (default: the build_fixtures trains)")
+    parser.add_argument("-d", "--dump", metavar="FILE", help="write the default fixtures into FILE and exit")
+    parser.add_argument("--departure", help="departure time of the default fixtures (HH:MM)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds waited by every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random ± seconds added to the latency")
+    parser.add_argument("--expire-after", type=int, help="requests after which a signature expires (Code 1033)")
+    parser.add_argument("--unavailable-rate", type=float, default=0.0, help="share of requests failing with HTTP 503")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.dump:
+        with open(args.dump, "w") as file:
+            json.dump(build_fixtures(args.departure, args.seed), file, indent=2)
+
+    else:
+        fixtures = build_fixtures(args.departure, args.seed)
+        if args.fixtures:
+            with open(args.fixtures) as file:
+                fixtures = json.load(file)
+
+        server = FakeItalo(fixtures, args.latency, args.jitter, args.expire_after, args.seed, port=args.port,
+                           unavailable_rate=args.unavailable_rate)
+        print("Serving the Italo endpoints on %s (trains: %s)" % (server.url, ", ".join(server.fixtures["trains"])))
+        try:
+            server.serve_forever()
+
+        except KeyboardInterrupt:
+            server.close()
@@ -1,7 +1,29 @@
+import os
+import re
 import uuid
 import json
+import time
+import random
+import math
+import sqlite3
+import hashlib
 import requests
 import datetime
+import asyncio
+import contextlib
+import heapq
+import itertools
+import threading
+import collections
+import urllib.parse
+import concurrent.futures
+import xml.etree.ElementTree
+
+try:
+    import httpx
+
+except ImportError:
+    httpx = None
 
 import logging
 import telegram
@@ -17,65 +39,131 @@ class ModuleItalo(RaspOneBaseModule):
     DESCRIPTION = "Search Italo trains"
 
     USAGE = {
-        "seats": "Search and get seats for a train"
+        "seats": "Search and get seats for a train, optionally only from a stop to another (e.g. 8918 Milano > Roma "
+                 "Termini)",
+        "metrics": "Requests sent to Italo since the start, by endpoint"
     }
 
+    SEATS_CONCURRENCY = 4
+    FARE_PROBING = True
+    SPLIT_LAYOUTS = True
+
     def __init__(self, core):
         super().__init__(core)
 
-        self.tm = TrainManager()
+        # latency, status and business codes of every request to Italo
+        self.request_metrics = RequestMetrics()
+        # GetAvailableTrains answers shared by the hops of all the searches, so trains of the same corridor reuse them
+        self.availability_cache = AsyncAvailabilityCache()
+        # warm anonymous signatures shared by all the searches
+        self.session_pool = AsyncSessionPool(lambda: AsyncTrainManager(grm_cache=False,
+                                                                       on_request=self.request_metrics.record,
+                                                                       availability_cache=self.availability_cache),
+                                             size=self.SEATS_CONCURRENCY * 2)
+        # realtime schedules shared by all the searches, so popular trains are looked up once a minute at most
+        self.schedule_cache = AsyncScheduleCache()
+        # content-hashed layout assets already uploaded, shared by all the pages of the same train type
+        self.layout_urls = {}
 
     async def command(self, update, context):
         message = ""
         markdown = None
         if context.args[0].lower() == "seats":
             context.args.pop(0)
-            if len(context.args) != 1 or not context.args[0].isnumeric():
-                message = "Error: expecting one Train Number!"
+            # stations are codes or names: names with spaces are separated by ">"
+            stations = " ".join(context.args[1:])
+            journey = [station.strip() for station in stations.split(">")] if ">" in stations else context.args[1:]
+            if not context.args or not context.args[0].isnumeric() or len(journey) not in (0, 2):
+                message = "Error: expecting one Train Number, optionally followed by two stations!"
+
+            else:
+                async with AsyncTrainManager(session_pool=self.session_pool, schedule_cache=self.schedule_cache,
+                                             on_request=self.request_metrics.record,
+                                             availability_cache=self.availability_cache) as tm:
+                    message, markdown = await self._search(tm, update, context.args[0], journey or None)
+
+        elif context.args[0].lower() == "metrics":
+            request_stats = self.request_metrics.summary()
+            if not request_stats:
+                message = "No requests yet!"
 
             else:
-                train_schedule, error = self._get_train(context.args[0])
-                if error:
-                    message = str(error)
-
-                else:
-                    await update.effective_message.reply_text(
-                        "🚂 Train: {TrainNumber}\n"
-                        "From: {DepartureStationDescription} ({DepartureDate})"
-                        " - To: {ArrivalStationDescription} ({ArrivalDate})\n"
-                        "Stops:\n".format_map(train_schedule) +
+                message = "📊 Italo requests:\n" + "\n".join(
+                    "  • {0}: {requests} in {time:.1f}s{1}".format(
+                        endpoint, "".join(", Code %s ×%d" % code_count for code_count in stats["codes"].items()),
+                        **stats)
+                    for endpoint, stats in request_stats.items())
+
+        await update.effective_message.reply_text(message, parse_mode=markdown)
+
+    async def _search(self, tm, update, train_number, journey=None):
+        train_schedule, error = await self._get_train(tm, train_number)
+        hops = None
+        if not error and journey:
+            try:
+                # only the hops of the journey are scanned
+                hops = journey_hops(train_schedule["StazioniNonFerme"], *journey)
+
+            except UserError as user_error:
+                error = user_error
+
+        if error:
+            return str(error), None
+
+        train_message = "🚂 Train: {TrainNumber}\n" \
+                        "From: {DepartureStationDescription} ({DepartureDate})" \
+                        " - To: {ArrivalStationDescription} ({ArrivalDate})\n" \
+                        "Stops:\n".format_map(train_schedule) + \
                         "\n".join(
                             "  • {LocationDescription} ({ActualArrivalTime} - {ActualDepartureTime})".format_map(
                                 stop)
-                            for stop in train_schedule["StazioniNonFerme"]) +
-                        "\n\n _Searching for seats.. (this may take a while)_",
-                        parse_mode=telegram.constants.ParseMode.MARKDOWN
-                    )
+                            for stop in train_schedule["StazioniNonFerme"])
 
-                    page_url, error = self._get_seats_and_upload(context.args[0])
-                    if error:
-                        message = str(error)
+        progress_message = await update.effective_message.reply_text(
+            train_message + "\n\n _Searching for seats.. (this may take a while)_",
+            parse_mode=telegram.constants.ParseMode.MARKDOWN
+        )
 
-                    else:
-                        message = f"🚂 Done: [Italo {context.args[0]}]({page_url})"
-                        markdown = telegram.constants.ParseMode.MARKDOWN
+        page_url, error = await self._get_seats_and_upload(tm, train_schedule, progress_message, train_message, hops)
+        if error:
+            return str(error), None
 
-        await update.effective_message.reply_text(message, parse_mode=markdown)
+        return f"🚂 Done: [Italo {train_number}]({page_url})", telegram.constants.ParseMode.MARKDOWN
 
-    def _get_train(self, train_number):
+    @staticmethod
+    async def _get_train(tm, train_number):
         try:
 
-            train_schedule = self.tm.search_train(train_number)
+            train_schedule = await tm.search_train(train_number)
             return train_schedule, None
 
         except Exception as error:
             return False, error
 
-    def _get_seats_and_upload(self, train_number):
+    async def _get_seats_and_upload(self, tm, train_schedule, progress_message, train_message, hops=None):
         try:
-            page_html = self.tm.search_seats()
-            file_key = uuid.uuid4().urn[9:] + "/italo_%s.html" % train_number
-            object_url, error = self.core.modules["instances"]["s3"].add_object(file_key, page_html, "text/html")
+            hop_results = []
+            async for hop_result in tm.iter_seats(train_schedule, concurrency=self.SEATS_CONCURRENCY,
+                                                  fare_probing=self.FARE_PROBING, hops=hops):
+                hop_results.append(hop_result)
+                await self._show_progress(progress_message, train_message, hop_results)
+
+            if all(hop_result["error"] for hop_result in hop_results):
+                raise ItaloError("No hop scanned (%s)" % hop_results[0]["error"])
+
+            availability = SeatAvailability.from_hops(train_schedule, hop_results)
+
+            if self.SPLIT_LAYOUTS:
+                page_html = tm.render_page_shell(availability,
+                                                 await self._upload_layout(tm, availability.equipment_type))
+
+            else:
+                page_html = await tm.create_html(availability)
+
+            file_key = uuid.uuid4().urn[9:] + "/italo_%s.html" % train_schedule["TrainNumber"]
+            # the S3 client is blocking: keep it off the bot loop
+            object_url, error = await asyncio.to_thread(self.core.modules["instances"]["s3"].add_object,
+                                                        file_key, page_html, "text/html")
             if error:
                 raise error
 
@@ -84,6 +172,34 @@ class ModuleItalo(RaspOneBaseModule):
         except Exception as error:
             return False, error
 
+    @staticmethod
+    async def _show_progress(progress_message, train_message, hop_results):
+        try:
+            await progress_message.edit_text(
+                train_message + "\n\nSeats:\n" +
+                "\n".join(("  ✗ {name}: unknown" if hop_result["error"] else "  ✓ {name}: {0} free").format(
+                    len(hop_result["seats"]), **hop_result)
+                    for hop_result in sorted(hop_results, key=lambda hop_result: hop_result["hop"])) +
+                "\n\n _Searching for seats.. (this may take a while)_",
+                parse_mode=telegram.constants.ParseMode.MARKDOWN
+            )
+
+        except telegram.error.TelegramError as error:
+            # progress is best effort (e.g. edits rate limited): the search goes on
+            module_logger.debug("Italo progress not shown: %s" % error)
+
+    async def _upload_layout(self, tm, train_type):
+        asset_name, asset_js = await tm.create_layout_asset(train_type)
+        if asset_name not in self.layout_urls:
+            object_url, error = await asyncio.to_thread(self.core.modules["instances"]["s3"].add_object,
+                                                        "italo-layouts/" + asset_name, asset_js, "text/javascript")
+            if error:
+                raise error
+
+            self.layout_urls[asset_name] = object_url
+
+        return self.layout_urls[asset_name]
+
 
 # BELOW ITALO CODE - REMEMBER TO COMMENT print()
 
@@ -96,6 +212,14 @@ class UserError(Exception):
     """User Error"""
 
 
+class InvalidSessionError(ItaloError):
+    """Invalid Session Error (Code 1033)"""
+
+
+class UnavailableError(ItaloError):
+    """Unavailable Error (timeouts, connection errors or 5xx answers after the retries, or failed HTTP calls)"""
+
+
 train_mapping = {
     "AGV": {
         "1": 869, "2": 870, "3": 871, "4": 872, "5": 873, "6": 874, "7": 875, "8": 876, "9": 877, "10": 878, "11": 879
@@ -109,56 +233,1089 @@ train_mapping = {
     }
 }
 
+# connections kept alive per host by default: enough for create_grm_map to fetch all the layouts of a train at once
+POOL_SIZE = max(len(set(compartments.values())) for compartments in train_mapping.values())
 
-class TrainManager:
-    def __init__(self):
-        self.session = requests.Session()
 
-        # self.session.verify = False
-        # self.session.proxies = {"https": "https://127.0.0.1:8080"}
+class GRMCache:
+    """On-disk cache of the GRM layouts (the compartment SVGs), keyed by ContentID.
 
-        self.signature = None
-        self.train_schedule = None
+    Each ContentID points to a content-addressed `<md5>.svg` blob and remembers the MD5checksum given by the server:
+    entries younger than `max_age` are served without any network call, older ones are revalidated sending their
+    checksum to GetGRMContent.
+    """
+
+    def __init__(self, path=os.path.join(os.path.expanduser("~"), ".cache", "italo", "grm"),
+                 max_age=datetime.timedelta(days=7)):
+        self.path = path
+        self.max_age = max_age
+        self._entries = {}
+
+    def load(self, grm_id):
+        if grm_id not in self._entries:
+            try:
+                with open(os.path.join(self.path, "%s.json" % grm_id)) as file:
+                    entry = json.load(file)
+
+                with open(os.path.join(self.path, "%s.svg" % entry["blob"])) as file:
+                    entry["data"] = file.read()
+
+            except (OSError, ValueError, KeyError):
+                return None
+
+            self._entries[grm_id] = entry
+
+        return self._entries[grm_id]
+
+    def is_fresh(self, entry):
+        return time.time() - entry["time"] < self.max_age.total_seconds()
+
+    def store(self, grm_id, checksum, data=None):
+        # data=None refreshes the age of an entry the server reported as unchanged
+        if data is None:
+            data = self._entries[grm_id]["data"]
+
+        entry = {"checksum": checksum, "blob": hashlib.md5(data.encode()).hexdigest(), "time": time.time()}
+        os.makedirs(self.path, exist_ok=True)
+        if not os.path.exists(os.path.join(self.path, "%s.svg" % entry["blob"])):
+            self._write("%s.svg" % entry["blob"], data)
+
+        self._write("%s.json" % grm_id, json.dumps(entry))
+        self._entries[grm_id] = dict(entry, data=data)
+        return self._entries[grm_id]
+
+    def _write(self, file_name, content):
+        # write-then-rename, so concurrent scans never read a half written layout
+        temp_path = os.path.join(self.path, "%s.%s.tmp" % (file_name, threading.get_ident()))
+        with open(temp_path, "w") as file:
+            file.write(content)
+
+        os.replace(temp_path, os.path.join(self.path, file_name))
+
+
+class SessionPool:
+    """Warm WWW_Anonymous sessions leased to the scans.
+
+    Every session is a worker manager with its own HTTP session and signature (the booking held by HoldBooking lives
+    server-side in the session, so concurrent hops can't share one): at most `size` workers exist, and a signature
+    older than `max_age` is renewed before being leased.
+    """
+
+    def __init__(self, factory=None, size=4, max_age=datetime.timedelta(minutes=10)):
+        self.factory = factory or (lambda: TrainManager(grm_cache=False))
+        self.size = size
+        self.max_age = max_age
+        self.logins = 0
+
+        self._idle = []
+        self._workers = 0
+        self._condition = threading.Condition()
+
+    def _take(self):
+        if self._idle:
+            return self._idle.pop()
+
+        if self._workers < self.size:
+            self._workers += 1
+            return self.factory()
+
+        return None
+
+    def _is_stale(self, worker):
+        return not worker.signature or time.monotonic() - worker.signature_time > self.max_age.total_seconds()
+
+    def _give(self, worker):
+        if worker.signature:
+            self._idle.append(worker)
+            return None
+
+        # the login failed: forget the worker, a new one will be created on demand
+        self._workers -= 1
+        return worker
+
+    @contextlib.contextmanager
+    def lease(self):
+        with self._condition:
+            while (worker := self._take()) is None:
+                self._condition.wait()
+
+        try:
+            if self._is_stale(worker):
+                self.logins += 1
+                worker.get_session()
+
+            yield worker
+
+        finally:
+            with self._condition:
+                broken_worker = self._give(worker)
+                self._condition.notify()
+
+            if broken_worker:
+                broken_worker.close()
+
+    def close(self):
+        with self._condition:
+            idle_workers, self._idle = self._idle, []
+            self._workers -= len(idle_workers)
+
+        for worker in idle_workers:
+            worker.close()
+
+
+class AsyncSessionPool(SessionPool):
+    """SessionPool of AsyncTrainManager workers"""
+
+    def __init__(self, factory=None, size=4, max_age=datetime.timedelta(minutes=10)):
+        super().__init__(factory or (lambda: AsyncTrainManager(grm_cache=False)), size, max_age)
+        self._condition = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def lease(self):
+        async with self._condition:
+            while (worker := self._take()) is None:
+                await self._condition.wait()
+
+        try:
+            if self._is_stale(worker):
+                self.logins += 1
+                await worker.get_session()
+
+            yield worker
+
+        finally:
+            async with self._condition:
+                broken_worker = self._give(worker)
+                self._condition.notify()
+
+            if broken_worker:
+                await broken_worker.close()
+
+    async def close(self):
+        async with self._condition:
+            idle_workers, self._idle = self._idle, []
+            self._workers -= len(idle_workers)
+
+        for worker in idle_workers:
+            await worker.close()
+
+
+class FareProbe:
+    """Fares to hold for a hop, and the union of the seats they open.
+
+    Exhaustively every fare is held, otherwise fares are grouped by FARE_GROUP_FIELDS (fares of the same cabin open
+    the same seat map) and only one per group is probed: the next fares of a group are held only when the previous
+    ones returned no seat map. Every group is probed, as each cabin class opens its own compartments.
+    Iterate it to get the FareSellKeys to hold, and `add()` the seat availability of each held one.
+    """
+
+    FARE_GROUP_FIELDS = ("ProductClass",)
+
+    def __init__(self, fares, probing=False):
+        self.fares = len(fares)
+        self.groups = self.group_fares(fares) if probing else [[fare] for fare in fares]
+        self.probing = probing
+
+        self.seats = set()
+        self.equipment_seats = set()
         self.train_type = None
+        self.holds = 0
+        self.seat_maps = 0
+        self._group_done = False
+
+    @classmethod
+    def group_fares(cls, fares):
+        groups = {}
+        for fare in fares:
+            group_key = tuple(fare.get(field) for field in cls.FARE_GROUP_FIELDS)
+            # without any grouping field a fare can't be compared with the others: probe it alone
+            groups.setdefault(group_key if any(group_key) else fare["FareSellKey"], []).append(fare)
+
+        return list(groups.values())
+
+    def __iter__(self):
+        for group in self.groups:
+            self._group_done = False
+            for fare in group:
+                self.holds += 1
+                yield fare["FareSellKey"]
+                if self._group_done:
+                    break
+
+    def add(self, seat_map):
+        self.seat_maps += 1
+        if not seat_map:
+            return
+
+        equipment_type, seats = seat_map
+        if not self.train_type:
+            self.train_type = equipment_type
+
+        for seat_id, is_free in seats:
+            self.equipment_seats.add(seat_id)
+            if is_free:
+                self.seats.add(seat_id)
+
+        self._group_done = True
+
+    @property
+    def skipped(self):
+        return self.fares - self.holds
+
+    def as_dict(self):
+        return {"fares": self.fares, "holds": self.holds, "seat_maps": self.seat_maps}
+
+
+class SeatAvailability:
+    """Free seats of a train, hop by hop.
+
+    Seats are indexed once per equipment (`seats`, naturally sorted "<compartment>_<seat>" ids) and every hop keeps
+    its free seats as a bitset: bit i of `free[hop]` is set when seats[i] is free between stops[hop] and stops[hop + 1].
+    Hops that couldn't be scanned keep their "error" and no free seats, like the ones left out of the scan
+    (NOT_SCANNED).
+    """
+
+    NOT_SCANNED = "Not scanned"
+
+    def __init__(self, train_number, stops, equipment_type, seats, hops, free):
+        self.train_number = train_number
+        self.stops = stops
+        self.equipment_type = equipment_type
+        self.seats = seats
+        self.seat_index = {seat: index for index, seat in enumerate(seats)}
+        self.hops = hops
+        self.free = free
+
+    @classmethod
+    def from_hops(cls, train_schedule, hop_results):
+        scanned_hops = {hop["hop"] for hop in hop_results}
+        hop_results = sorted(list(hop_results) + [
+            BaseTrainManager.skipped_hop_result(train_schedule, hop + 1)
+            for hop in range(len(train_schedule["StazioniNonFerme"]) - 1) if hop not in scanned_hops],
+            key=lambda hop: hop["hop"])
+        equipment_type = next((hop["train_type"] for hop in hop_results if hop["train_type"]), None)
+        seats = sorted(set().union(*(hop["equipment_seats"] for hop in hop_results)), key=natural_key)
+        seat_bits = {seat: 1 << index for index, seat in enumerate(seats)}
+
+        return cls(train_schedule["TrainNumber"], train_schedule["StazioniNonFerme"], equipment_type, seats,
+                   [{"name": hop["name"], "code": hop["code"], "probe": hop["probe"], "error": hop.get("error")}
+                    for hop in hop_results],
+                   [sum(seat_bits[seat] for seat in hop["seats"]) for hop in hop_results])
+
+    def _bits_to_seats(self, bits):
+        seats = []
+        while bits:
+            lowest_bit = bits & -bits
+            seats.append(self.seats[lowest_bit.bit_length() - 1])
+            bits ^= lowest_bit
+
+        return seats
+
+    def is_free(self, seat, hop):
+        return bool(self.free[hop] >> self.seat_index[seat] & 1)
+
+    def free_seats(self, hop):
+        return self._bits_to_seats(self.free[hop])
+
+    def free_between(self, from_stop, to_stop):
+        """Seats free on every hop from stops[from_stop] to stops[to_stop]"""
+        bits = (1 << len(self.seats)) - 1
+        for hop in range(from_stop, to_stop):
+            bits &= self.free[hop]
+
+        return self._bits_to_seats(bits)
+
+    def free_for_journey(self):
+        return self.free_between(0, len(self.hops))
+
+    def _free_run(self, bits, hops):
+        # seats of bits by number of the given hops they stay free on, in a row
+        free_run = collections.Counter()
+        for hop in hops:
+            bits &= self.free[hop]
+            if not bits:
+                break
+
+            free_run.update(self._bits_to_seats(bits))
+
+        return free_run
+
+    def find_seats(self, from_station, to_station):
+        """Seats to travel from one stop to another (by LocationCode or LocationDescription, see stop_index).
+
+        Returns the "legs" with the fewest seat changes: a single leg when a seat is free all the way, otherwise every
+        leg goes as far as some seat stays free (legs without "seats" aren't free at all, or are on "unknown" hops).
+        The seats of a leg are ranked by the hops they stay free on around it, longest first.
+        """
+        journey = journey_hops(self.stops, from_station, to_station)
+        from_stop, to_stop = journey.start, journey.stop
+        legs = []
+        hop = from_stop
+        while hop < to_stop:
+            # greedily ride each leg as far as possible: the fewest legs cover the journey
+            leg_start, bits = hop, self.free[hop]
+            while hop + 1 < to_stop and bits & self.free[hop + 1]:
+                hop += 1
+                bits &= self.free[hop]
+
+            hop += 1
+            free_run = self._free_run(bits, range(leg_start - 1, -1, -1)) + \
+                self._free_run(bits, range(hop, len(self.hops)))
+            legs.append({"from": self.stops[leg_start]["LocationDescription"],
+                         "to": self.stops[hop]["LocationDescription"],
+                         "seats": sorted(self._bits_to_seats(bits), key=lambda seat: -free_run[seat])})
+
+        return {"from": self.stops[from_stop]["LocationDescription"], "to": self.stops[to_stop]["LocationDescription"],
+                "legs": legs, "unknown": [self.hops[hop]["name"] for hop in range(from_stop, to_stop)
+                                          if self.is_unknown(hop)]}
+
+    def free_intervals(self, seat):
+        """(from_stop, to_stop) ranges where the seat is free without interruption"""
+        intervals = []
+        for hop in range(len(self.hops)):
+            if not self.is_free(seat, hop):
+                continue
+
+            if intervals and intervals[-1][1] == hop:
+                intervals[-1] = (intervals[-1][0], hop + 1)
 
-    def retrieve_realtime(self, train_number: int):
-        response = self.session.get("https://italoinviaggio.italotreno.it/api/RicercaTrenoService"
-                                    "?TrainNumber=%s" % train_number)
+            else:
+                intervals.append((hop, hop + 1))
+
+        return intervals
+
+    def is_unknown(self, hop):
+        return bool(self.hops[hop].get("error"))
+
+    def is_scanned(self, hop):
+        return self.hops[hop].get("error") != self.NOT_SCANNED
+
+    def seat_masks(self):
+        """Seats free on at least one hop, mapped to one char per hop: "1" when free, "0" when busy, "?" when unknown"""
+        hop_unknown = [self.is_unknown(hop) for hop in range(len(self.hops))]
+        seat_masks = {}
+        for index, seat in enumerate(self.seats):
+            seat_mask = "".join("1" if hop_free >> index & 1 else "?" if hop_unknown[hop] else "0"
+                                for hop, hop_free in enumerate(self.free))
+            if "1" in seat_mask:
+                seat_masks[seat] = seat_mask
+
+        return seat_masks
+
+    def _previous_free(self, previous, hop):
+        if previous.seats == self.seats:
+            return previous.free[hop]
+
+        # the seat index changed between the scans: rebuild the previous bitset on this one
+        return sum(1 << self.seat_index[seat] for seat in previous.free_seats(hop) if seat in self.seat_index)
+
+    def changes(self, previous=None):
+        """Seats that became free ("freed") or busy ("taken") on each hop since `previous`, a former scan of this train.
+
+        Only the hops with changes are listed, skipping the unknown ones. Without `previous`, every free seat counts as
+        freed.
+        """
+        changes = []
+        for hop, hop_free in enumerate(self.free):
+            if self.is_unknown(hop) or (previous and previous.is_unknown(hop)):
+                continue
+
+            previous_free = self._previous_free(previous, hop) if previous else 0
+            if hop_free == previous_free:
+                continue
+
+            changes.append({"hop": hop, "name": self.hops[hop]["name"],
+                            "freed": self._bits_to_seats(hop_free & ~previous_free),
+                            "taken": self._bits_to_seats(previous_free & ~hop_free)})
+
+        return changes
+
+    def to_segments(self):
+        return [dict(hop, seats=self.free_seats(index)) for index, hop in enumerate(self.hops)]
+
+    def to_json(self):
+        return {
+            "train_number": self.train_number,
+            "stops": self.stops,
+            "equipment_type": self.equipment_type,
+            "seats": self.seats,
+            "hops": [dict(hop, free="%x" % self.free[index]) for index, hop in enumerate(self.hops)]
+        }
+
+    @classmethod
+    def from_json(cls, availability_json):
+        return cls(availability_json["train_number"], availability_json["stops"],
+                   availability_json["equipment_type"], availability_json["seats"],
+                   [{key: value for key, value in hop.items() if key != "free"} for hop in availability_json["hops"]],
+                   [int(hop["free"], 16) for hop in availability_json["hops"]])
+
+
+class SeatLayout:
+    """Seat geometry of a train: the compartment and position of every seat ("<compartment>_<seat>"), and its
+    adjacent seats (see parse_grm_geometry and neighbours).
+    """
+
+    # seats of a compartment are adjacent when closer than this many times its typical seat spacing (side by side,
+    # facing, or diagonal)
+    NEIGHBOUR_DISTANCE = 1.5
+
+    def __init__(self, train_type, seats, neighbours):
+        self.train_type = train_type
+        self.seats = seats
+        self.neighbours = neighbours
+
+    @classmethod
+    def from_geometry(cls, train_type, grm_geometry):
+        """Layout of a train from the (positions, neighbours) of the seats of each of its GRM layouts, by ContentID"""
+        seats, neighbours = {}, {}
+        for compartment_number, grm_id in train_mapping[train_type].items() if train_type else ():
+            positions, grm_neighbours = grm_geometry[grm_id]
+            for designator, designator_neighbours in grm_neighbours.items():
+                seat_id = "%s_%s" % (compartment_number, designator)
+                seats[seat_id] = {"compartment": compartment_number, "position": positions[designator]}
+                neighbours[seat_id] = {"%s_%s" % (compartment_number, neighbour)
+                                       for neighbour in designator_neighbours}
+
+        return cls(train_type, seats, neighbours)
+
+    @classmethod
+    def neighbours(cls, positions):
+        """Adjacent seats of a compartment, from their positions"""
+        if len(positions) < 2:
+            return {designator: set() for designator in positions}
+
+        # a grid of buckets as large as the threshold: neighbours are in the same bucket or in the 8 around it
+        nearest = sorted(min(math.dist(position, other) for other_designator, other in positions.items()
+                             if other_designator != designator) for designator, position in positions.items())
+        threshold = cls.NEIGHBOUR_DISTANCE * nearest[len(nearest) // 2] or 1
+        buckets = collections.defaultdict(list)
+        for designator, (x, y) in positions.items():
+            buckets[int(x // threshold), int(y // threshold)].append(designator)
+
+        neighbours = {}
+        for designator, (x, y) in positions.items():
+            column, row = int(x // threshold), int(y // threshold)
+            neighbours[designator] = {other for column_offset in (-1, 0, 1) for row_offset in (-1, 0, 1)
+                                      for other in buckets[column + column_offset, row + row_offset]
+                                      if other != designator and math.dist((x, y), positions[other]) <= threshold}
+
+        return neighbours
+
+    def _grow_group(self, seed, size, free):
+        # add the free neighbour closest to the centre of the group, until it's large enough
+        group, frontier = [seed], self.neighbours[seed] & free
+        while len(group) < size and frontier:
+            centre = [sum(coordinates) / len(group) for coordinates in
+                      zip(*(self.seats[seat]["position"] for seat in group))]
+            seat = min(frontier, key=lambda candidate: (math.dist(self.seats[candidate]["position"], centre),
+                                                        natural_key(candidate)))
+            group.append(seat)
+            frontier = (frontier | self.neighbours[seat] & free).difference(group)
+
+        return group if len(group) == size else None
+
+    def _spread(self, group):
+        centre = [sum(coordinates) / len(group) for coordinates in zip(*(self.seats[seat]["position"]
+                                                                        for seat in group))]
+        return sum(math.dist(self.seats[seat]["position"], centre) for seat in group)
+
+    def find_groups(self, availability, size, from_station=None, to_station=None, limit=None):
+        """Groups of `size` adjacent seats, all free from one stop to another (the whole journey by default).
+
+        Every free seat seeds a group, grown with the closest free neighbours: the distinct groups are returned
+        most compact first.
+        """
+        journey = journey_hops(availability.stops, from_station, to_station) if from_station else \
+            range(len(availability.hops))
+        free = set(availability.free_between(journey.start, journey.stop)) & self.seats.keys()
+
+        groups = {}
+        for seed in sorted(free, key=natural_key):
+            group = self._grow_group(seed, size, free)
+            if group:
+                groups.setdefault(frozenset(group), sorted(group, key=natural_key))
+
+        return sorted(groups.values(), key=self._spread)[:limit]
+
+
+class AvailabilityStore:
+    """SQLite history of the scans, to follow the load of the trains over days.
+
+    Every scanned hop keeps its free seats as a bitmap (little endian bytes of SeatAvailability.free) over the seat
+    index of the equipment, stored once; scans are keyed by train, departure date, equipment type and time. Queries
+    stream their rows, so months of scans are never loaded at once.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS seat_indexes (
+            id INTEGER PRIMARY KEY, equipment_type TEXT, seats TEXT, seat_count INTEGER,
+            UNIQUE (equipment_type, seats));
+        CREATE TABLE IF NOT EXISTS scans (
+            id INTEGER PRIMARY KEY, train_number TEXT, date TEXT, time INTEGER, equipment_type TEXT,
+            seat_index INTEGER REFERENCES seat_indexes (id));
+        CREATE INDEX IF NOT EXISTS scans_train ON scans (train_number, time);
+        -- free is NULL when the hop couldn't be scanned; departure is the time the train leaves from_station
+        CREATE TABLE IF NOT EXISTS hops (
+            scan INTEGER REFERENCES scans (id), hop INTEGER, from_station TEXT, to_station TEXT, departure INTEGER,
+            free BLOB, free_count INTEGER, PRIMARY KEY (scan, hop)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS hops_from_station ON hops (from_station);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # scans of a batch are recorded from its threads
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+        self._seat_indexes = {}
+
+    def _seat_index(self, equipment_type, seats):
+        key = (equipment_type, json.dumps(seats))
+        if key not in self._seat_indexes:
+            self._connection.execute("INSERT OR IGNORE INTO seat_indexes (equipment_type, seats, seat_count) "
+                                     "VALUES (?, ?, ?)", key + (len(seats),))
+            self._seat_indexes[key] = self._connection.execute(
+                "SELECT id FROM seat_indexes WHERE equipment_type IS ? AND seats = ?", key).fetchone()[0]
+
+        return self._seat_indexes[key]
+
+    def record(self, availability, scan_time=None):
+        """Store the scanned hops of a SeatAvailability, returning the id of the scan"""
+        scan_time = int((scan_time or datetime.datetime.now()).timestamp())
+        stops = availability.stops
+        bitmap_size = (len(availability.seats) + 7) // 8
+        with self._lock, self._connection:
+            scan_id = self._connection.execute(
+                "INSERT INTO scans (train_number, date, time, equipment_type, seat_index) VALUES (?, ?, ?, ?, ?)",
+                (str(availability.train_number),
+                 departure_datetime(stops[0]["EstimatedArrivalTime"]).date().isoformat(), scan_time,
+                 availability.equipment_type,
+                 self._seat_index(availability.equipment_type, availability.seats))).lastrowid
+
+            self._connection.executemany("INSERT INTO hops VALUES (?, ?, ?, ?, ?, ?, ?)", [
+                (scan_id, hop, stops[hop]["LocationCode"], stops[hop + 1]["LocationCode"],
+                 int(departure_datetime(stops[hop]["EstimatedArrivalTime"]).timestamp()),
+                 None if availability.is_unknown(hop) else availability.free[hop].to_bytes(bitmap_size, "little"),
+                 None if availability.is_unknown(hop) else bin(availability.free[hop]).count("1"))
+                for hop in range(len(availability.hops)) if availability.is_scanned(hop)])
+
+        return scan_id
+
+    @staticmethod
+    def _time_range(since, until):
+        return int(since.timestamp()) if since else 0, int(until.timestamp()) if until else 2 ** 62
+
+    def occupancy(self, train_number, since=None, until=None):
+        """Free seats and occupancy (busy share of the seats) of every hop of a train, scan by scan, oldest first"""
+        for scan_time, date, hop, from_station, to_station, free_count, seat_count in self._connection.execute(
+                "SELECT s.time, s.date, h.hop, h.from_station, h.to_station, h.free_count, i.seat_count "
+                "FROM scans s JOIN hops h ON h.scan = s.id JOIN seat_indexes i ON i.id = s.seat_index "
+                "WHERE s.train_number = ? AND s.time >= ? AND s.time < ? AND h.free IS NOT NULL "
+                "ORDER BY s.time, h.hop", (str(train_number),) + self._time_range(since, until)):
+            yield {"time": datetime.datetime.fromtimestamp(scan_time), "date": date, "hop": hop,
+                   "from": from_station, "to": to_station, "free": free_count,
+                   "occupancy": 1 - free_count / seat_count if seat_count else None}
+
+    def emptiest_trains(self, from_station, to_station, lead_time, tolerance=datetime.timedelta(hours=1),
+                        since=None, until=None):
+        """Trains from a station to another (LocationCodes), emptiest first, `lead_time` before leaving from_station.
+
+        Every train and departure date counts once, with the scan closest to lead_time (± tolerance) knowing every
+        hop of the route: its seats free all the way (AND of the hop bitmaps) are averaged over the dates. Only trains
+        of the day can be scanned (see departure_datetime), so lead times of a day or more find no scan.
+        """
+        rows = self._connection.execute(
+            "SELECT s.id, s.train_number, s.date, i.seat_count, b.hop - a.hop + 1, h.free "
+            "FROM scans s JOIN hops a ON a.scan = s.id AND a.from_station = ? "
+            "JOIN hops b ON b.scan = s.id AND b.to_station = ? AND b.hop >= a.hop "
+            "JOIN hops h ON h.scan = s.id AND h.hop BETWEEN a.hop AND b.hop "
+            "JOIN seat_indexes i ON i.id = s.seat_index "
+            "WHERE a.departure - s.time BETWEEN ? AND ? AND s.time >= ? AND s.time < ? "
+            "ORDER BY s.train_number, s.date, ABS(a.departure - s.time - ?), s.id, h.hop",
+            (from_station, to_station, (lead_time - tolerance).total_seconds(),
+             (lead_time + tolerance).total_seconds()) + self._time_range(since, until) +
+            (lead_time.total_seconds(),))
+
+        trains, counted = {}, set()
+        # rows come scan by scan, the closest to lead_time first for every train and date
+        for (_, train_number, date, seat_count, hop_count), scan_rows in itertools.groupby(rows, lambda row: row[:5]):
+            hop_bitmaps = [row[5] for row in scan_rows]
+            if (train_number, date) in counted or len(hop_bitmaps) != hop_count or None in hop_bitmaps:
+                continue
+
+            counted.add((train_number, date))
+            free = -1
+            for hop_bitmap in hop_bitmaps:
+                free &= int.from_bytes(hop_bitmap, "little")
+
+            stats = trains.setdefault(train_number, {"train_number": train_number, "dates": 0, "free": 0,
+                                                     "occupancy": 0})
+            stats["dates"] += 1
+            stats["free"] += bin(free).count("1")
+            stats["occupancy"] += 1 - bin(free).count("1") / seat_count if seat_count else 1
+
+        return sorted(({"train_number": stats["train_number"], "dates": stats["dates"],
+                        "free": stats["free"] / stats["dates"], "occupancy": stats["occupancy"] / stats["dates"]}
+                       for stats in trains.values()), key=lambda stats: stats["occupancy"])
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ScheduleCache:
+    """Realtime train schedules (RicercaTrenoService) by train number, kept in memory for `ttl`.
+
+    Concurrent lookups of the same train share a single request. Cached schedules are shared: don't modify them.
+    """
+
+    def __init__(self, ttl=datetime.timedelta(minutes=1)):
+        self.ttl = ttl
+        self._schedules = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, train_number):
+        expiry, train_schedule = self._schedules.get(train_number, (0, None))
+        return train_schedule if expiry > time.monotonic() else None
+
+    def _store(self, train_number, train_schedule):
+        self._schedules[train_number] = (time.monotonic() + self.ttl.total_seconds(), train_schedule)
+
+    def get(self, train_number, fetch):
+        train_number = str(train_number)
+        with self._lock:
+            train_schedule = self._cached(train_number)
+            if train_schedule:
+                return train_schedule
+
+            pending = self._pending.get(train_number)
+            is_fetching = pending is None
+            if is_fetching:
+                pending = self._pending[train_number] = concurrent.futures.Future()
+
+        if not is_fetching:
+            return pending.result()
+
+        try:
+            train_schedule = fetch(train_number)
+            with self._lock:
+                self._store(train_number, train_schedule)
+
+            pending.set_result(train_schedule)
+            return train_schedule
+
+        except BaseException as error:
+            pending.set_exception(error)
+            raise
+
+        finally:
+            with self._lock:
+                del self._pending[train_number]
+
+
+class AsyncScheduleCache(ScheduleCache):
+    """ScheduleCache for coroutine fetches"""
+
+    async def get(self, train_number, fetch):
+        train_number = str(train_number)
+        while True:
+            train_schedule = self._cached(train_number)
+            if train_schedule:
+                return train_schedule
+
+            pending = self._pending.get(train_number)
+            if pending is None:
+                break
+
+            # wait() doesn't raise the lookup's cancellation here: when its owner is cancelled, look it up again
+            await asyncio.wait([pending])
+            if not pending.cancelled():
+                return pending.result()
 
+        pending = self._pending[train_number] = asyncio.get_running_loop().create_future()
+        try:
+            train_schedule = await fetch(train_number)
+            self._store(train_number, train_schedule)
+
+        except asyncio.CancelledError:
+            # the caller was cancelled, not the lookup: the others waiting for it retry
+            pending.cancel()
+            raise
+
+        except BaseException as error:
+            pending.set_exception(error)
+            # nobody may be waiting for this lookup: don't let asyncio log the exception as never retrieved
+            pending.exception()
+            raise
+
+        else:
+            pending.set_result(train_schedule)
+
+        finally:
+            del self._pending[train_number]
+
+        return train_schedule
+
+
+class AvailabilityCache:
+    """GetAvailableTrains journeys (JourneySellKey and fares) by station pair and time window, kept in memory for `ttl`.
+
+    One answer lists every train between two stations in its window: the scans of the other trains of the corridor
+    get their journey from it, without a request. Concurrent lookups of the same station pair share a single request.
+    """
+
+    def __init__(self, ttl=datetime.timedelta(minutes=1)):
+        self.ttl = ttl
+        self._journeys = collections.defaultdict(dict)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def find_journey(journeys, train_number):
+        return next(((journey_sell_key, fares) for journey_sell_key, fares in journeys
+                     if str(train_number) in (field.strip() for field in journey_sell_key.split("~"))), None)
+
+    def _cached(self, stations, train_number):
+        windows = self._journeys[stations]
+        for window, (expiry, journeys) in list(windows.items()):
+            if expiry <= time.monotonic():
+                del windows[window]
+                continue
+
+            journey = self.find_journey(journeys, train_number)
+            if journey:
+                return journey
+
+        return None
+
+    def _store(self, stations, window, journeys):
+        self._journeys[stations][window] = (time.monotonic() + self.ttl.total_seconds(), journeys)
+
+    @classmethod
+    def _train_journey(cls, journeys, train_number):
+        journey = cls.find_journey(journeys, train_number)
+        if journey is None:
+            raise ItaloError("Invalid train detail")
+
+        return journey
+
+    def get(self, stations, window, train_number, fetch):
+        """Journey of a train from stations[0] to stations[1], fetching the journeys of the window when not cached"""
+        while True:
+            with self._lock:
+                journey = self._cached(stations, train_number)
+                if journey:
+                    return journey
+
+                pending = self._pending.get(stations)
+                is_fetching = pending is None
+                if is_fetching:
+                    pending = self._pending[stations] = concurrent.futures.Future()
+
+            if is_fetching:
+                break
+
+            # another train of the corridor is being looked up: its journeys may include this one
+            with contextlib.suppress(Exception):
+                pending.result()
+
+        try:
+            journeys = fetch()
+            with self._lock:
+                self._store(stations, window, journeys)
+
+        except BaseException as error:
+            pending.set_exception(error)
+            raise
+
+        else:
+            pending.set_result(journeys)
+
+        finally:
+            with self._lock:
+                del self._pending[stations]
+
+        return self._train_journey(journeys, train_number)
+
+
+class AsyncAvailabilityCache(AvailabilityCache):
+    """AvailabilityCache for coroutine fetches"""
+
+    async def get(self, stations, window, train_number, fetch):
+        while True:
+            journey = self._cached(stations, train_number)
+            if journey:
+                return journey
+
+            if stations not in self._pending:
+                break
+
+            # wait() raises neither the failure nor the cancellation of the other lookup: either way, look again
+            await asyncio.wait([self._pending[stations]])
+
+        pending = self._pending[stations] = asyncio.get_running_loop().create_future()
+        try:
+            journeys = await fetch()
+            self._store(stations, window, journeys)
+
+        except asyncio.CancelledError:
+            # the caller was cancelled, not the lookup: the others waiting for it retry
+            pending.cancel()
+            raise
+
+        except BaseException as error:
+            pending.set_exception(error)
+            pending.exception()
+            raise
+
+        else:
+            pending.set_result(journeys)
+
+        finally:
+            del self._pending[stations]
+
+        return self._train_journey(journeys, train_number)
+
+
+class TokenBucket:
+    """Request rate shared by managers and workers: `rate` requests per second, in bursts of up to `burst`.
+
+    take() reserves a request and returns the seconds to wait before sending it, so threads and coroutines alike can
+    wait their turn.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._time) * self.rate) - 1
+            self._time = now
+            return max(0.0, -self._tokens / self.rate)
+
+
+class RequestMetrics:
+    """Counters and latency histograms of the HTTP calls, by endpoint: pass its `record` as on_request.
+
+    `to_prometheus()` exports them in the Prometheus text format; with a `logger`, every call is also logged as JSON.
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        # (endpoint, status, business code) -> calls
+        self.requests = collections.Counter()
+        self.bytes = collections.Counter()
+        self.wire_bytes = collections.Counter()
+        # endpoint -> calls by bucket (the last one is +Inf), plus their total time
+        self.latency = collections.defaultdict(lambda: [0] * (len(self.BUCKETS) + 1))
+        self.latency_sum = collections.Counter()
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        status = str(event["status"]) if event["status"] else "error"
+        code = str(event["code"]) if event["code"] is not None else ""
+        bucket = next((index for index, bound in enumerate(self.BUCKETS) if event["elapsed"] <= bound),
+                      len(self.BUCKETS))
+        with self._lock:
+            self.requests[event["endpoint"], status, code] += 1
+            self.bytes[event["endpoint"]] += event["bytes"]
+            self.wire_bytes[event["endpoint"]] += event["wire_bytes"]
+            self.latency[event["endpoint"]][bucket] += 1
+            self.latency_sum[event["endpoint"]] += event["elapsed"]
+
+        if self.logger:
+            self.logger.info(json.dumps(dict(event, event="italo_request")))
+
+    def summary(self):
+        """Calls, time, bytes (decoded and on the wire) and business codes by endpoint, slowest first"""
+        with self._lock:
+            summary = {endpoint: {"requests": sum(calls), "time": self.latency_sum[endpoint],
+                                  "bytes": self.bytes[endpoint], "wire_bytes": self.wire_bytes[endpoint], "codes": {}}
+                       for endpoint, calls in self.latency.items()}
+            for (endpoint, _, code), count in self.requests.items():
+                if code:
+                    summary[endpoint]["codes"][code] = summary[endpoint]["codes"].get(code, 0) + count
+
+        return dict(sorted(summary.items(), key=lambda item: item[1]["time"], reverse=True))
+
+    def to_prometheus(self):
+        lines = ["# HELP italo_requests_total HTTP calls to the Italo endpoints, by status and business code",
+                 "# TYPE italo_requests_total counter"]
+        with self._lock:
+            for (endpoint, status, code), count in sorted(self.requests.items()):
+                lines.append('italo_requests_total{endpoint="%s",status="%s",code="%s"} %d' % (endpoint, status,
+                                                                                              code, count))
+
+            lines += ["# HELP italo_response_bytes_total Response payload bytes of the Italo endpoints",
+                      "# TYPE italo_response_bytes_total counter"]
+            for endpoint, total in sorted(self.bytes.items()):
+                lines.append('italo_response_bytes_total{endpoint="%s"} %d' % (endpoint, total))
+
+            lines += ["# HELP italo_response_wire_bytes_total Compressed response bytes from the Italo endpoints",
+                      "# TYPE italo_response_wire_bytes_total counter"]
+            for endpoint, total in sorted(self.wire_bytes.items()):
+                lines.append('italo_response_wire_bytes_total{endpoint="%s"} %d' % (endpoint, total))
+
+            lines += ["# HELP italo_request_duration_seconds Latency of the HTTP calls to the Italo endpoints",
+                      "# TYPE italo_request_duration_seconds histogram"]
+            for endpoint, calls in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ("+Inf",), calls):
+                    cumulative += count
+                    lines.append('italo_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d' % (
+                        endpoint, bound, cumulative))
+
+                lines.append('italo_request_duration_seconds_sum{endpoint="%s"} %f' % (endpoint,
+                                                                                      self.latency_sum[endpoint]))
+                lines.append('italo_request_duration_seconds_count{endpoint="%s"} %d' % (endpoint, cumulative))
+
+        return "\n".join(lines) + "\n"
+
+
+class BaseTrainManager:
+    """Requests and responses of the Italo endpoints, shared by the sync and the async managers"""
+
+    REALTIME_BASE_URL = "https://italoinviaggio.italotreno.it"
+    BOOKING_BASE_URL = "https://big.ntvspa.it"
+
+    # seconds to connect, and to wait for each answer
+    CONNECT_TIMEOUT = 5
+    REQUEST_TIMEOUT = 30
+    # transient failures (timeouts, connection errors and RETRY_STATUSES) are retried up to RETRIES times, waiting a
+    # random time up to RETRY_BACKOFF * 2^retry seconds (RETRY_BACKOFF_MAX at most) before each retry
+    RETRIES = 3
+    RETRY_BACKOFF = 0.5
+    RETRY_BACKOFF_MAX = 8
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, grm_cache=None, session_pool=None, schedule_cache=None, base_url=None, on_request=None,
+                 http2=False, availability_cache=None, rate_limit=None):
+        self.http2 = http2
+        # rate_limit, a TokenBucket, paces every request (retries included)
+        self.rate_limit = rate_limit
+        # base_url serves both the realtime and the booking endpoints in place of the Italo hosts (see fake_italo.py)
+        self.base_url = base_url
+        # on_request(event) is called after every HTTP call, retries included (see _record_request and RequestMetrics)
+        self.on_request = on_request
+        # grm_cache=False disables the layout cache
+        self.grm_cache = GRMCache() if grm_cache is None else grm_cache
+        # seat geometry parsed from each layout, by ContentID (see seat_layout)
+        self.grm_geometry = {}
+        self.schedule_cache = schedule_cache or self._schedule_cache_type()
+        # share it with the workers (see _spawn_worker): their hops find the journeys of the other trains
+        self.availability_cache = availability_cache or self._availability_cache_type()
+        # without a shared pool, each manager creates its own one at the first scan
+        self.session_pool = session_pool
+        self._own_session_pool = False
+        self.signature = None
+        self.signature_time = None
+
+    def _realtime_url(self, train_number):
+        return "%s/api/RicercaTrenoService?TrainNumber=%s" % (self.base_url or self.REALTIME_BASE_URL, train_number)
+
+    def _booking_url(self, service):
+        return "%s/BIG/v7/Rest/%s" % (self.base_url or self.BOOKING_BASE_URL, service)
+
+    @staticmethod
+    def _business_code(content):
+        # business errors are small {"Code": ..., "Message": ...} answers: don't parse the large ones twice
+        if len(content) > 4096:
+            return None
+
+        try:
+            response_json = json.loads(content)
+            return response_json.get("Code") if isinstance(response_json, dict) else None
+
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _endpoint(url):
+        return urllib.parse.urlsplit(url).path.rstrip("/").split("/")[-1]
+
+    def _timeout(self):
+        if isinstance(self.session, requests.Session):
+            return self.CONNECT_TIMEOUT, self.REQUEST_TIMEOUT
+
+        return httpx.Timeout(self.REQUEST_TIMEOUT, connect=self.CONNECT_TIMEOUT)
+
+    def _retry_delay(self, retry):
+        return random.uniform(0, min(self.RETRY_BACKOFF_MAX, self.RETRY_BACKOFF * 2 ** retry))
+
+    def _unavailable(self, url, failure):
+        return UnavailableError("%s unavailable after %d attempts: %s" % (self._endpoint(url), self.RETRIES + 1,
+                                                                          failure))
+
+    def _failed(self, url, error):
+        return UnavailableError("%s failed: %s: %s" % (self._endpoint(url), type(error).__name__, error))
+
+    def _record_request(self, method, url, started, response=None, error=None, attempt=0):
+        if not self.on_request:
+            return
+
+        self.on_request({
+            "endpoint": self._endpoint(url),
+            "method": method,
+            "attempt": attempt,
+            "status": response.status_code if response is not None else None,
+            "code": self._business_code(response.content) if response is not None else None,
+            "error": type(error).__name__ if error else None,
+            "elapsed": time.monotonic() - started,
+            "bytes": len(response.content) if response is not None else 0,
+            # compressed size, when the server sends it
+            "wire_bytes": int(response.headers.get("Content-Length", len(response.content)))
+            if response is not None else 0
+        })
+
+    @staticmethod
+    def _parse_realtime(response):
         try:
             response_json = response.json()
             if response_json["IsEmpty"]:
                 raise UserError("Invalid train number")
 
-            self.train_schedule = response_json["TrainSchedule"]
+            return response_json["TrainSchedule"]
 
         except (requests.exceptions.RequestException, Exception):
             raise UserError("Invalid train number")
 
-    def get_session(self):
-        login_response = self.session.post("https://big.ntvspa.it/BIG/v7/Rest/SessionManager.svc/Login",
-                                           json={"Login": {
-                                               "Username": "WWW_Anonymous", "Password": "Accenture$1", "Domain": "WWW",
-                                               "VersionNumber": "10.0.1"
-                                           }, "SourceSystem": 2})
+    def _login_request(self):
+        return self._booking_url("SessionManager.svc/Login"), {"Login": {
+            "Username": "WWW_Anonymous", "Password": "Accenture$1", "Domain": "WWW",
+            "VersionNumber": "10.0.1"
+        }, "SourceSystem": 2}
 
+    def _parse_login(self, login_response):
         try:
             login_json = login_response.json()
             if "Signature" not in login_json:
                 raise ItaloError("Invalid login")
 
             self.signature = login_json["Signature"]
+            self.signature_time = time.monotonic()
 
         except (requests.exceptions.RequestException, Exception):
             raise ItaloError("Invalid login")
 
-    def clear_session(self):
-        self.session.post("https://big.ntvspa.it/BIG/v7/Rest/SessionManager.svc/ClearSession",
-                          json={"LoyaltyTransactionId": None, "Signature": self.signature})
+    def _clear_session_request(self):
+        return self._booking_url("SessionManager.svc/ClearSession"), {
+            "LoyaltyTransactionId": None, "Signature": self.signature}
 
-    def get_available_trains(self, departure_station, arrival_station, interval_start_time, interval_end_time):
-        available_response = self.session.post("https://big.ntvspa.it/BIG/v7/Rest/BookingManager.svc"
-                                               "/GetAvailableTrains", json={
+    def _available_trains_request(self, departure_station, arrival_station, interval_start_time, interval_end_time):
+        return self._booking_url("BookingManager.svc/GetAvailableTrains"), {
             "GetAvailableTrains": {"RoundTrip": False,
                                    "DepartureStation": departure_station.replace("BO2", "BC_"),
                                    "ArrivalStation": arrival_station.replace("BO2", "BC_"),
@@ -175,33 +1332,30 @@ class TrainManager:
                                    "OverrideIntervalTimeRestriction": True, "AvailabilityFilter": 1,
                                    "FareClassControl": 0, "IDPartner": None},
             "Signature": self.signature,
-            "SourceSystem": 2})
+            "SourceSystem": 2}
 
+    @staticmethod
+    def _parse_available_trains(available_response):
+        # every journey of the answer is kept, for the other trains of the corridor (see AvailabilityCache)
         try:
             available_json = available_response.json()
             if "Code" in available_json and available_json["Code"] == 1033:
-                raise ItaloError("Invalid session")
+                raise InvalidSessionError("Invalid session")
 
             elif not available_json["JourneyDateMarkets"][0]["Journeys"]:
                 raise ItaloError("Invalid train")
 
-            for journey in available_json["JourneyDateMarkets"][0]["Journeys"]:
-                if not self.train_schedule["TrainNumber"] in journey["JourneySellKey"]:
-                    continue
+            return [(journey["JourneySellKey"], journey["Segments"][0]["Fares"] or [])
+                    for journey in available_json["JourneyDateMarkets"][0]["Journeys"]]
 
-                fare_sell_keys = []
-                if journey["Segments"][0]["Fares"] and len(journey["Segments"][0]["Fares"]):
-                    fare_sell_keys = [fare["FareSellKey"] for fare in journey["Segments"][0]["Fares"]]
-
-                return journey["JourneySellKey"], fare_sell_keys
-
-            raise ItaloError("Invalid train detail")
+        except InvalidSessionError:
+            raise
 
         except (requests.exceptions.RequestException, Exception):
             raise ItaloError("Invalid train detail")
 
-    def hold_booking(self, journey_sell_key, fare_sell_key):
-        booking_response = self.session.post("https://big.ntvspa.it/BIG/v7/Rest/BookingManager.svc/HoldBooking", json={
+    def _hold_booking_request(self, journey_sell_key, fare_sell_key):
+        return self._booking_url("BookingManager.svc/HoldBooking"), {
             "Signature": self.signature,
             "SourceSystem": 2, "Journeys": [{"CurrencyCode": "EUR", "FareSellKey": fare_sell_key,
                                              "JourneySellKey": journey_sell_key,
@@ -211,8 +1365,10 @@ class TrainManager:
             "BookingContact": {"DistributionOption": 1, "Culture": 1}, "WaiveFee": False, "RequestFareLock": False,
             "JourneySpecialOperation": None, "AncillaryService": None, "RequestAncillaryService": True,
             "RequestPetAncillaryService": False, "AssetNumber": None
-        })
+        }
 
+    @staticmethod
+    def _parse_hold_booking(booking_response):
         try:
             booking_json = booking_response.json()
             if "Code" in booking_json:
@@ -222,7 +1378,9 @@ class TrainManager:
                 elif booking_json["Code"] == 1004:
                     return None
 
-                # if booking_json["Code"] == 1033:
+                elif booking_json["Code"] == 1033:
+                    raise InvalidSessionError("Invalid session")
+
                 raise ItaloError("Invalid session")
 
             elif "Booking" not in booking_json:
@@ -230,58 +1388,113 @@ class TrainManager:
 
             return True
 
+        except InvalidSessionError:
+            raise
+
         except (requests.exceptions.RequestException, Exception):
             raise ItaloError("Invalid booking")
 
-    def get_seat_availability(self, segment_sell_key):
-        seat_response = self.session.post("https://big.ntvspa.it/BIG/v7/Rest/BookingManager.svc/GetSeatAvailability",
-                                          json={"Signature": self.signature,
-                                                "Segment": {"SegmentSellKey": segment_sell_key}, "SourceSystem": 2})
+    def _seat_availability_request(self, segment_sell_key):
+        return self._booking_url("BookingManager.svc/GetSeatAvailability"), {
+            "Signature": self.signature, "Segment": {"SegmentSellKey": segment_sell_key}, "SourceSystem": 2}
 
+    @staticmethod
+    def _compact_seat_object(obj):
+        # object_hook of the seat map: called innermost first, it shrinks every seat to (designator, is free) and
+        # every compartment to (designator, seats) as soon as they're decoded, dropping the other fields (geometry,
+        # properties, fees...), so the whole document is never held as dicts
+        if "SeatDesignator" in obj:
+            return obj["SeatDesignator"], obj.get("Assignable") is True and obj.get("SeatAvailability") == 5
+
+        elif "CompartmentDesignator" in obj:
+            return obj["CompartmentDesignator"], obj.get("Seats") or []
+
+        elif "Compartments" in obj or "Equipment" in obj or "Code" in obj:
+            return obj
+
+        return None
+
+    @classmethod
+    def _parse_seat_availability(cls, seat_response):
+        """(equipment type, [("<compartment>_<seat>", is free), ...]) of a seat map, None when there's none"""
         try:
-            seat_json = seat_response.json()
+            seat_json = json.loads(seat_response.content, object_hook=cls._compact_seat_object)
             if "Code" in seat_json:
                 if seat_json["Code"] == 1513:
                     return None
 
-                # if seat_json["Code"] == 1033:
-                # raise ItaloError("Invalid session")
+                elif seat_json["Code"] == 1033:
+                    raise InvalidSessionError("Invalid session")
 
                 return None
 
             elif "Equipment" not in seat_json:
                 raise ItaloError("Invalid seat availability response")
 
-            return seat_json
+            return seat_json["Equipment"]["EquipmentType"], [
+                (compartment + "_" + seat, is_free)
+                for compartment, seats in seat_json["Equipment"]["Compartments"] for seat, is_free in seats]
+
+        except InvalidSessionError:
+            raise
 
         except (requests.exceptions.RequestException, Exception):
             raise ItaloError("Invalid booking")
 
-    def get_grm_content(self, grm_id):
-        grm_response = self.session.post("https://big.ntvspa.it/BIG/v7/Rest/BookingManager.svc/GetGRMContent",
-                                         json={"ContentID": grm_id, "MD5checksum": "", "SourceSystem": 2})
+    def _cached_grm(self, grm_id):
+        return self.grm_cache.load(grm_id) if self.grm_cache else None
 
+    def _grm_content_request(self, grm_id, md5_checksum=""):
+        return self._booking_url("BookingManager.svc/GetGRMContent"), {
+            "ContentID": grm_id, "MD5checksum": md5_checksum, "SourceSystem": 2}
+
+    def _parse_grm_content(self, grm_id, grm_response, cached_entry=None):
         try:
             grm_json = grm_response.json()
-            if "Data" not in grm_json:
+            if grm_json.get("Data"):
+                data = bytearray(grm_json["Data"]).decode()
+                checksum = grm_json.get("MD5checksum") or hashlib.md5(data.encode()).hexdigest()
+
+            elif cached_entry:
+                # the server answers without Data when the checksum we sent is still current
+                data, checksum = None, cached_entry["checksum"]
+
+            else:
                 raise ItaloError("Invalid GRM response")
 
-            return bytearray(grm_json["Data"]).decode().replace('data-name="not_available"',
-                                                                'data-name="not_available" visibility="hidden"')
+            if self.grm_cache:
+                data = self.grm_cache.store(grm_id, checksum, data)["data"]
+
+            return self._grm_svg(data)
 
         except (requests.exceptions.RequestException, Exception):
             raise ItaloError("Invalid grm")
 
-    def create_grm_map(self):
-        if not self.train_type:
-            return "<h3>The train is full</h3>"
+    @staticmethod
+    def _grm_svg(data):
+        return data.replace('data-name="not_available"', 'data-name="not_available" visibility="hidden"')
+
+    def seat_layout(self, train_type, grm_contents):
+        """SeatLayout of a train from its GRM layouts, parsing each ContentID only once (until its layout changes)"""
+        for grm_id, grm_svg in grm_contents.items():
+            if grm_id not in self.grm_geometry or self.grm_geometry[grm_id][0] != grm_svg:
+                positions = parse_grm_geometry(grm_svg)
+                self.grm_geometry[grm_id] = (grm_svg, (positions, SeatLayout.neighbours(positions)))
+
+        return SeatLayout.from_geometry(train_type, {grm_id: self.grm_geometry[grm_id][1] for grm_id in grm_contents})
 
+    @staticmethod
+    def _grm_ids(train_type):
+        # EVI trains are two coupled EVO units: their compartments share the same layouts
+        return sorted(set(train_mapping[train_type].values()))
+
+    @staticmethod
+    def render_grm_map(train_type, grm_contents):
         grm_map_html = ""
-        for compartment_number in sorted([int(x) for x in train_mapping[self.train_type].keys()]):
+        for compartment_number, grm_id in train_mapping[train_type].items():
             grm_map_html += "<div class='compartment'>"
 
-            grm_map_html += "<div>" + self.get_grm_content(
-                train_mapping[self.train_type][str(compartment_number)]) + "</div>"
+            grm_map_html += "<div>" + grm_contents[grm_id] + "</div>"
 
             grm_map_html += "<div><h1>Compartment {0}</h1>" \
                             "<div id='compartment-detail-{0}' class='compartment-detail'></div>" \
@@ -291,45 +1504,7 @@ class TrainManager:
 
         return grm_map_html
 
-    def create_html(self, segments):
-        page_html = """<html>
-        <head>
-        <style>
-                body {
-            font-family: sans-serif;
-            text-align: center;
-        }
-        .train-segments {
-            display: grid;
-            grid-template-columns: 80% 20%;
-            grid-gap: 2px;
-        }
-        .compartment {
-            display: grid;
-            grid-template-columns: 40% 55%;
-            grid-gap: 20px;
-        }
-        red {
-            color: #7c0f06;
-        }
-        green {
-            color: #0bc4a5;
-            font-weight: bold;
-        }
-        </style>
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        </head>
-        <body>
-            <h1>Train """ + str(self.train_schedule["TrainNumber"]) + "</h1>\n"
-        page_html += "<div class=\"train-segments\">\n"
-        for x in range(len(segments)):
-            page_html += "<div>%s</div>" % segments[x]["code"]
-            page_html += "<div><button onclick=\"showSeat(%d)\">SHOW</button></div>\n" % x
-
-        page_html += "<div></div><div><button onclick=\"showSeat()\">RESET</button></div>\n"
-        page_html += "</div><br/>"
-        page_html += self.create_grm_map()
-        page_html += """<script>
+    SEATS_SCRIPT = """
             let anchors = document.getElementsByTagName('a');
             for (let i=0; i < anchors.length; i++) {
                 anchors[i].addEventListener('click', onSeatClick);
@@ -352,25 +1527,40 @@ class TrainManager:
                         lastElement = compartmentDetailElement;
                         compartmentDetailElement.parentElement.scrollIntoView();
 
-                        compartmentDetailElement.innerHTML = `<center><em><b>Seat: ${seatNumber}</b></em><br/>`
-                            + event_path[i].dataset.compartmentName
-                            + "</center><br/><br/>";
+                        let seatFree = getSeatFree(compartmentNumber, seatNumber),
+                            detailHtml = `<center><em><b>Seat: ${seatNumber}</b></em><br/>`
+                                + event_path[i].dataset.compartmentName
+                                + "</center><br/><br/>";
 
-                        compartmentDetailElement.innerHTML += "<div style='text-align: center;'><div style='display: inline-block; text-align: left;'>"
+                        detailHtml += "<div style='text-align: center;'><div style='display: inline-block; text-align: left;'>"
 
-                        trainSegments.forEach((segment) => {
-                            compartmentDetailElement.innerHTML += `<li>${segment.name}: ${(segment.seats.includes(compartmentNumber + "_" + seatNumber)) ? "<green>Available</green>": "<red>Busy</red>"}</li>`
+                        trainSegments.forEach((segment, segmentId) => {
+                            detailHtml += `<li>${segment.name}: ${(seatFree[segmentId] === "1") ? "<green>Available</green>": segment.error === "Not scanned" ? "<em>Not scanned</em>" : segment.error ? "<em>Unknown</em>" : "<red>Busy</red>"}</li>`
                         })
 
-                        compartmentDetailElement.innerHTML += "</div></div>"
+                        compartmentDetailElement.innerHTML = detailHtml + "</div></div>"
                         break
                     }
                 }
             }
 
+            // seatAvailability maps "<compartment>_<seat>" to one char per segment ("1": free, "0": busy, "?": unknown
+            // or not scanned), seats never free are omitted
+            function getSeatFree(compartmentNumber, seatNumber) {
+                return seatAvailability[compartmentNumber + "_" + seatNumber]
+                    || trainSegments.map(segment => segment.error ? "?" : "0").join("");
+            }
+
+            function paintSeat(seatAnchor, fill, stroke) {
+                let seatPathElements = seatAnchor.getElementsByTagName("path")
+                for (let ii=0; ii < seatPathElements.length; ii++) {
+                    seatPathElements[ii].style.fill = fill
+                    seatPathElements[ii].style.stroke = stroke
+                }
+            }
+
             function showSeat(segmentId) {
-                let compartmentSvgs = document.getElementsByTagName('svg'),
-                        filterTrainSegments = (segmentId !== undefined) ? trainSegments.slice(segmentId, segmentId + 1) : trainSegments;
+                let compartmentSvgs = document.getElementsByTagName('svg');
 
                 for (let i=0; i < compartmentSvgs.length; i++) {
                     let compartmentName = compartmentSvgs[i].dataset.name;
@@ -382,89 +1572,999 @@ class TrainManager:
                         seatAnchors[i].dataset["compartment"] = compartmentNumber;
                         seatAnchors[i].dataset["compartmentName"] = compartmentName;
 
-                        let segmentsAvailable = filterTrainSegments.filter((segment) => segment.seats.includes(compartmentNumber + "_" + seatAnchors[i].href.baseVal))
-                        if (segmentsAvailable.length === filterTrainSegments.length) {
-                            let seatPathElements = seatAnchors[i].getElementsByTagName("path")
-                            for (let ii=0; ii < seatPathElements.length; ii++) {
-                                seatPathElements[ii].style.fill = "#0bc4a5"
-                                seatPathElements[ii].style.stroke = "#24ffda"
-                            }
-
-                        } else if (segmentsAvailable.length === 0) {
-                            let seatPathElements = seatAnchors[i].getElementsByTagName("path")
-                            for (let ii=0; ii < seatPathElements.length; ii++) {
-                                seatPathElements[ii].style.fill = "#7c0f06"
-                                seatPathElements[ii].style.stroke = "#A6160A"
-                            }
+                        // unknown and not scanned segments say nothing about the seat: colour from the known ones
+                        let seatFree = getSeatFree(compartmentNumber, seatAnchors[i].href.baseVal);
+                        if (segmentId !== undefined) seatFree = seatFree[segmentId];
+                        seatFree = seatFree.replaceAll("?", "");
+
+                        if (!seatFree) {
+                            paintSeat(seatAnchors[i], "#9e9e9e", "#c4c4c4")
+
+                        } else if (!seatFree.includes("0")) {
+                            paintSeat(seatAnchors[i], "#0bc4a5", "#24ffda")
+
+                        } else if (!seatFree.includes("1")) {
+                            paintSeat(seatAnchors[i], "#7c0f06", "#A6160A")
 
                         } else {
-                            let seatPathElements = seatAnchors[i].getElementsByTagName("path")
-                            for (let ii=0; ii < seatPathElements.length; ii++) {
-                                seatPathElements[ii].style.fill = "#eeab00"
-                                seatPathElements[ii].style.stroke = "#edcc8a"
-                            }
+                            paintSeat(seatAnchors[i], "#eeab00", "#edcc8a")
                         }
                     }
                 }
             }
             """
-        page_html += "const trainSegments = " + json.dumps(segments) + ";\n"
+
+    @staticmethod
+    def _render_page_head(availability):
+        page_html = """<html>
+        <head>
+        <style>
+                body {
+            font-family: sans-serif;
+            text-align: center;
+        }
+        .train-segments {
+            display: grid;
+            grid-template-columns: 80% 20%;
+            grid-gap: 2px;
+        }
+        .compartment {
+            display: grid;
+            grid-template-columns: 40% 55%;
+            grid-gap: 20px;
+        }
+        red {
+            color: #7c0f06;
+        }
+        green {
+            color: #0bc4a5;
+            font-weight: bold;
+        }
+        </style>
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        </head>
+        <body>
+            <h1>Train """ + str(availability.train_number) + "</h1>\n"
+        page_html += "<div class=\"train-segments\">\n"
+        for x in range(len(availability.hops)):
+            hop = availability.hops[x]
+            page_html += "<div>%s</div>" % ("%s: not scanned" % hop["name"] if not availability.is_scanned(x) else
+                                            "%s: unknown (%s)" % (hop["name"], hop["error"])
+                                            if availability.is_unknown(x) else hop["code"])
+            page_html += "<div><button onclick=\"showSeat(%d)\">SHOW</button></div>\n" % x
+
+        page_html += "<div></div><div><button onclick=\"showSeat()\">RESET</button></div>\n"
+        page_html += "</div><br/>"
+        return page_html
+
+    @staticmethod
+    def _render_availability_script(availability):
+        return "const trainSegments = " + json.dumps(availability.hops) + ";\n" + \
+               "const seatAvailability = " + json.dumps(availability.seat_masks()) + ";\n"
+
+    def render_html(self, availability, grm_map_html):
+        page_html = self._render_page_head(availability)
+        page_html += grm_map_html
+        page_html += "<script>" + self.SEATS_SCRIPT
+        page_html += self._render_availability_script(availability)
         page_html += "showSeat();\n</script>\n</body>\n</html>"
         return page_html
 
-    def search_train(self, train_number):
-        self.retrieve_realtime(train_number)
+    def render_layout_asset(self, train_type, grm_map_html):
+        """Static part of the page (compartment SVGs and seats script) for `render_page_shell`.
+
+        Returns a content-hashed file name, so the asset can be stored once and cached forever, and its content.
+        """
+        asset_js = "document.getElementById('grm-map').innerHTML = " + json.dumps(grm_map_html) + ";\n"
+        asset_js += self.SEATS_SCRIPT + "showSeat();\n"
+        asset_hash = hashlib.sha256(asset_js.encode()).hexdigest()[:16]
+        return "italo-layout-%s-%s.js" % (train_type or "full", asset_hash), asset_js
+
+    def render_page_shell(self, availability, layout_asset_url):
+        page_html = self._render_page_head(availability)
+        page_html += "<div id='grm-map'></div>\n"
+        page_html += "<script>" + self._render_availability_script(availability) + "</script>\n"
+        page_html += "<script src=\"%s\"></script>\n</body>\n</html>" % layout_asset_url
+        return page_html
 
-        if len(self.train_schedule["StazioniNonFerme"]) < 2:
+    @staticmethod
+    def _check_schedule(train_schedule):
+        if len(train_schedule["StazioniNonFerme"]) < 2:
             raise UserError("Not enough stops...")
 
-        return self.train_schedule
+        return train_schedule
+
+    @staticmethod
+    def _hop_query(train_schedule, hop_index):
+        departure_station = train_schedule["StazioniNonFerme"][hop_index - 1]["LocationCode"]
+        arrival_station = train_schedule["StazioniNonFerme"][hop_index]["LocationCode"]
+
+        interval_start_time, interval_end_time = convert_departure_timestamp(
+            train_schedule["StazioniNonFerme"][hop_index - 1]["EstimatedArrivalTime"]
+        )
+
+        return train_schedule["TrainNumber"], departure_station, arrival_station, interval_start_time, interval_end_time
+
+    @staticmethod
+    def _hop_result(train_schedule, hop_index, journey_sell_key, probe, started, error=None):
+        return {
+            "hop": hop_index - 1,
+            "name": train_schedule["StazioniNonFerme"][hop_index - 1]["LocationDescription"] + " ➔ " +
+                    train_schedule["StazioniNonFerme"][hop_index]["LocationDescription"],
+            "code": journey_sell_key,
+            "seats": probe.seats,
+            "equipment_seats": probe.equipment_seats,
+            "train_type": probe.train_type,
+            "probe": probe.as_dict(),
+            "elapsed": time.monotonic() - started,
+            "error": error
+        }
+
+    @classmethod
+    def _failed_hop_result(cls, train_schedule, hop_index, error, started):
+        return cls._hop_result(train_schedule, hop_index, None, FareProbe([]), started,
+                               "%s: %s" % (type(error).__name__, error))
+
+    @classmethod
+    def skipped_hop_result(cls, train_schedule, hop_index):
+        return cls._hop_result(train_schedule, hop_index, None, FareProbe([]), time.monotonic(),
+                               SeatAvailability.NOT_SCANNED)
+
+    @staticmethod
+    def _hop_indexes(train_schedule, hops=None):
+        if hops is None:
+            return range(1, len(train_schedule["StazioniNonFerme"]))
+
+        return [hop + 1 for hop in hops]
+
+    @staticmethod
+    def _pending_hops(train_schedule):
+        """Hops whose departure stop hasn't been reached yet (by its estimated time)"""
+        now = datetime.datetime.now()
+        return [hop for hop, stop in enumerate(train_schedule["StazioniNonFerme"][:-1])
+                if departure_datetime(stop["EstimatedArrivalTime"]) > now]
+
+    @staticmethod
+    def _keep_hop_result(hop_results, hop_result):
+        # a hop failing in a poll keeps the result of the previous one
+        if not hop_result["error"] or hop_result["hop"] not in hop_results:
+            hop_results[hop_result["hop"]] = hop_result
+
+    @staticmethod
+    def _watch_poll(train_schedule, hop_results, scanned_hops, previous):
+        # hops departed before the first poll are left out, as not scanned
+        availability = SeatAvailability.from_hops(train_schedule, list(hop_results.values()))
+        return availability, {"time": datetime.datetime.now().isoformat(timespec="seconds"),
+                              "train_number": train_schedule["TrainNumber"],
+                              "scanned": scanned_hops,
+                              "changes": availability.changes(previous)}
+
+    def _spawn_worker(self):
+        # on HTTP/2 the workers multiplex their requests on the connections of this manager
+        return type(self)(grm_cache=False, session=self.session if self.http2 else None, base_url=self.base_url,
+                          on_request=self.on_request, http2=self.http2, availability_cache=self.availability_cache,
+                          rate_limit=self.rate_limit)
+
+    def _lease_worker(self, concurrency):
+        if not self.session_pool:
+            self.session_pool = self._session_pool_type(self._spawn_worker, size=max(concurrency, 4))
+            self._own_session_pool = True
+
+        return self.session_pool.lease()
+
+
+class TrainManager(BaseTrainManager):
+    _session_pool_type = SessionPool
+    _schedule_cache_type = ScheduleCache
+    _availability_cache_type = AvailabilityCache
+    _transient_errors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                         requests.exceptions.ChunkedEncodingError) + ((httpx.TransportError,) if httpx else ())
+    _client_errors = (requests.exceptions.RequestException,) + ((httpx.HTTPError, httpx.InvalidURL) if httpx else ())
+
+    def __init__(self, grm_cache=None, session_pool=None, session=None, schedule_cache=None, base_url=None,
+                 on_request=None, http2=False, availability_cache=None, rate_limit=None):
+        super().__init__(grm_cache, session_pool, schedule_cache, base_url, on_request, http2, availability_cache,
+                         rate_limit)
+        # a shared session reuses its keep-alive connections for the realtime and GRM calls (see http_session)
+        self.session = session or http_session(http2=http2)
+        self._own_session = session is None
+
+        # self.session.verify = False
+        # self.session.proxies = {"https": "https://127.0.0.1:8080"}
+
+    def _request(self, method, url, payload=None):
+        for attempt in range(self.RETRIES + 1):
+            if attempt:
+                time.sleep(self._retry_delay(attempt - 1))
 
-    def search_seats(self):
-        self.get_session()
-        segments = []
+            if self.rate_limit:
+                time.sleep(self.rate_limit.take())
 
-        for hop_index in range(1, len(self.train_schedule["StazioniNonFerme"])):
-            self.clear_session()
-            departure_station = self.train_schedule["StazioniNonFerme"][hop_index - 1]["LocationCode"]
-            arrival_station = self.train_schedule["StazioniNonFerme"][hop_index]["LocationCode"]
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, json=payload, timeout=self._timeout())
 
-            interval_start_time, interval_end_time = convert_departure_timestamp(
-                self.train_schedule["StazioniNonFerme"][hop_index - 1]["EstimatedArrivalTime"]
-            )
+            except self._transient_errors as error:
+                self._record_request(method, url, started, error=error, attempt=attempt)
+                failure = error
+                continue
+
+            except self._client_errors as error:
+                # e.g. an answer that can't be decoded: not worth a retry, but it fails this call only (and its hop)
+                self._record_request(method, url, started, error=error, attempt=attempt)
+                raise self._failed(url, error) from error
+
+            except Exception as error:
+                self._record_request(method, url, started, error=error, attempt=attempt)
+                raise
+
+            self._record_request(method, url, started, response, attempt=attempt)
+            if response.status_code not in self.RETRY_STATUSES:
+                return response
+
+            failure = "HTTP %d" % response.status_code
+
+        raise self._unavailable(url, failure)
+
+    def retrieve_realtime(self, train_number: int):
+        return self.schedule_cache.get(train_number, self._fetch_realtime)
+
+    def _fetch_realtime(self, train_number):
+        response = self._request("GET", self._realtime_url(train_number))
+        return self._parse_realtime(response)
+
+    def get_session(self):
+        url, payload = self._login_request()
+        self._parse_login(self._request("POST", url, payload))
+
+    def clear_session(self):
+        url, payload = self._clear_session_request()
+        self._request("POST", url, payload)
 
-            segment_info = self.get_available_trains(departure_station, arrival_station,
-                                                     interval_start_time, interval_end_time)
+    def _post_renewing_session(self, build_request, parse_response, *args):
+        # on Code 1033 the signature has expired: log in again and replay the request with the new one
+        try:
+            url, payload = build_request(*args)
+            return parse_response(self._request("POST", url, payload))
+
+        except InvalidSessionError:
+            self.get_session()
+            url, payload = build_request(*args)
+            return parse_response(self._request("POST", url, payload))
+
+    def get_available_trains(self, train_number, departure_station, arrival_station,
+                             interval_start_time, interval_end_time):
+        return self.availability_cache.get(
+            (departure_station, arrival_station), (interval_start_time, interval_end_time), train_number,
+            lambda: self._post_renewing_session(self._available_trains_request, self._parse_available_trains,
+                                                departure_station, arrival_station, interval_start_time,
+                                                interval_end_time))
+
+    def hold_booking(self, journey_sell_key, fare_sell_key):
+        return self._post_renewing_session(self._hold_booking_request, self._parse_hold_booking,
+                                           journey_sell_key, fare_sell_key)
+
+    def get_seat_availability(self, segment_sell_key):
+        url, payload = self._seat_availability_request(segment_sell_key)
+        return self._parse_seat_availability(self._request("POST", url, payload))
+
+    def get_grm_content(self, grm_id):
+        cached_entry = self._cached_grm(grm_id)
+        if cached_entry and self.grm_cache.is_fresh(cached_entry):
+            return self._grm_svg(cached_entry["data"])
+
+        url, payload = self._grm_content_request(grm_id, cached_entry["checksum"] if cached_entry else "")
+        return self._parse_grm_content(grm_id, self._request("POST", url, payload), cached_entry)
+
+    def get_grm_contents(self, train_type):
+        if not train_type:
+            return {}
+
+        grm_ids = self._grm_ids(train_type)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(grm_ids)) as executor:
+            return dict(zip(grm_ids, executor.map(self.get_grm_content, grm_ids)))
+
+    def create_grm_map(self, train_type):
+        if not train_type:
+            return "<h3>The train is full</h3>"
 
-            segment_seats = set()
-            for fare_sell_key in segment_info[1]:
+        return self.render_grm_map(train_type, self.get_grm_contents(train_type))
+
+    def create_seat_layout(self, train_type):
+        return self.seat_layout(train_type, self.get_grm_contents(train_type))
+
+    def create_html(self, availability):
+        return self.render_html(availability, self.create_grm_map(availability.equipment_type))
+
+    def create_layout_asset(self, train_type):
+        return self.render_layout_asset(train_type, self.create_grm_map(train_type))
+
+    def search_train(self, train_number):
+        return self._check_schedule(self.retrieve_realtime(train_number))
+
+    def scan_hop(self, train_schedule, hop_index, fare_probing=False):
+        started = time.monotonic()
+        self.clear_session()
+        segment_info = self.get_available_trains(*self._hop_query(train_schedule, hop_index))
+
+        probe = FareProbe(segment_info[1], fare_probing)
+        for fare_sell_key in probe:
+            try:
+                if self.hold_booking(segment_info[0], fare_sell_key):
+                    probe.add(self.get_seat_availability(segment_info[0]))
+
+            except InvalidSessionError:
+                # the session expired between the hold and the seat map, taking the booking with it: hold it again
+                self.get_session()
                 if self.hold_booking(segment_info[0], fare_sell_key):
-                    seats = self.get_seat_availability(segment_info[0])
-                    if not seats:
+                    probe.add(self.get_seat_availability(segment_info[0]))
+
+        return self._hop_result(train_schedule, hop_index, segment_info[0], probe, started)
+
+    def iter_seats(self, train_schedule, concurrency=1, fare_probing=False, hops=None):
+        """Yield the result of every hop (or of the `hops` indexes only) as soon as it's scanned, in completion order
+        (see its "hop" index).
+
+        A hop that fails (e.g. UnavailableError once its requests run out of retries) doesn't stop the others: its
+        result has no seats and the "error". Closing the generator cancels the hops not started yet.
+        """
+        hop_indexes = self._hop_indexes(train_schedule, hops)
+
+        def scan(hop_index):
+            started = time.monotonic()
+            try:
+                with self._lease_worker(concurrency) as worker:
+                    return worker.scan_hop(train_schedule, hop_index, fare_probing)
+
+            except ItaloError as error:
+                return self._failed_hop_result(train_schedule, hop_index, error, started)
+
+        if min(concurrency, len(hop_indexes)) <= 1:
+            for hop_index in hop_indexes:
+                yield scan(hop_index)
+
+            return
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(concurrency, len(hop_indexes)))
+        try:
+            for future in concurrent.futures.as_completed([executor.submit(scan, hop_index)
+                                                           for hop_index in hop_indexes]):
+                yield future.result()
+
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def search_seats(self, train_schedule, concurrency=1, fare_probing=False):
+        return SeatAvailability.from_hops(train_schedule, list(self.iter_seats(train_schedule, concurrency,
+                                                                               fare_probing)))
+
+    def watch(self, train_number, interval=datetime.timedelta(minutes=5), concurrency=1, fare_probing=False):
+        """Scan the train every `interval` until it departs from its last hop, yielding (availability, poll).
+
+        Only the hops not departed yet are scanned again, the others keep their last result. `poll` holds the time,
+        the "scanned" hops and the "changes" since the previous poll (see SeatAvailability.changes).
+        """
+        hop_results = {}
+        availability = None
+        while True:
+            train_schedule = self.search_train(train_number)
+            scanned_hops = self._pending_hops(train_schedule)
+            if not scanned_hops:
+                return
+
+            for hop_result in self.iter_seats(train_schedule, concurrency, fare_probing, scanned_hops):
+                self._keep_hop_result(hop_results, hop_result)
+
+            availability, poll = self._watch_poll(train_schedule, hop_results, scanned_hops, availability)
+            yield availability, poll
+            time.sleep(interval.total_seconds())
+
+    def close(self):
+        if self._own_session:
+            self.session.close()
+
+        if self._own_session_pool:
+            self.session_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncTrainManager(BaseTrainManager):
+    """Same API as TrainManager, as coroutines on an httpx.AsyncClient"""
+
+    _session_pool_type = AsyncSessionPool
+    _schedule_cache_type = AsyncScheduleCache
+    _availability_cache_type = AsyncAvailabilityCache
+    _transient_errors = (httpx.TransportError,) if httpx else ()
+    _client_errors = (httpx.HTTPError, httpx.InvalidURL) if httpx else ()
+
+    def __init__(self, grm_cache=None, session_pool=None, session=None, schedule_cache=None, base_url=None,
+                 on_request=None, http2=False, availability_cache=None, rate_limit=None):
+        super().__init__(grm_cache, session_pool, schedule_cache, base_url, on_request, http2, availability_cache,
+                         rate_limit)
+        if httpx is None:
+            raise ItaloError("AsyncTrainManager requires httpx")
+
+        self.session = session or async_http_session(http2=http2)
+        self._own_session = session is None
+
+    async def _request(self, method, url, payload=None):
+        for attempt in range(self.RETRIES + 1):
+            if attempt:
+                await asyncio.sleep(self._retry_delay(attempt - 1))
+
+            if self.rate_limit:
+                await asyncio.sleep(self.rate_limit.take())
+
+            started = time.monotonic()
+            try:
+                response = await self.session.request(method, url, json=payload, timeout=self._timeout())
+
+            except self._transient_errors as error:
+                self._record_request(method, url, started, error=error, attempt=attempt)
+                failure = error
+                continue
+
+            except self._client_errors as error:
+                # e.g. an answer that can't be decoded: not worth a retry, but it fails this call only (and its hop)
+                self._record_request(method, url, started, error=error, attempt=attempt)
+                raise self._failed(url, error) from error
+
+            except Exception as error:
+                self._record_request(method, url, started, error=error, attempt=attempt)
+                raise
+
+            self._record_request(method, url, started, response, attempt=attempt)
+            if response.status_code not in self.RETRY_STATUSES:
+                return response
+
+            failure = "HTTP %d" % response.status_code
+
+        raise self._unavailable(url, failure)
+
+    async def retrieve_realtime(self, train_number: int):
+        return await self.schedule_cache.get(train_number, self._fetch_realtime)
+
+    async def _fetch_realtime(self, train_number):
+        response = await self._request("GET", self._realtime_url(train_number))
+        return self._parse_realtime(response)
+
+    async def get_session(self):
+        url, payload = self._login_request()
+        self._parse_login(await self._request("POST", url, payload))
+
+    async def clear_session(self):
+        url, payload = self._clear_session_request()
+        await self._request("POST", url, payload)
+
+    async def _post_renewing_session(self, build_request, parse_response, *args):
+        try:
+            url, payload = build_request(*args)
+            return parse_response(await self._request("POST", url, payload))
+
+        except InvalidSessionError:
+            await self.get_session()
+            url, payload = build_request(*args)
+            return parse_response(await self._request("POST", url, payload))
+
+    async def get_available_trains(self, train_number, departure_station, arrival_station,
+                                   interval_start_time, interval_end_time):
+        return await self.availability_cache.get(
+            (departure_station, arrival_station), (interval_start_time, interval_end_time), train_number,
+            lambda: self._post_renewing_session(self._available_trains_request, self._parse_available_trains,
+                                                departure_station, arrival_station, interval_start_time,
+                                                interval_end_time))
+
+    async def hold_booking(self, journey_sell_key, fare_sell_key):
+        return await self._post_renewing_session(self._hold_booking_request, self._parse_hold_booking,
+                                                 journey_sell_key, fare_sell_key)
+
+    async def get_seat_availability(self, segment_sell_key):
+        url, payload = self._seat_availability_request(segment_sell_key)
+        return self._parse_seat_availability(await self._request("POST", url, payload))
+
+    async def get_grm_content(self, grm_id):
+        cached_entry = self._cached_grm(grm_id)
+        if cached_entry and self.grm_cache.is_fresh(cached_entry):
+            return self._grm_svg(cached_entry["data"])
+
+        url, payload = self._grm_content_request(grm_id, cached_entry["checksum"] if cached_entry else "")
+        return self._parse_grm_content(grm_id, await self._request("POST", url, payload), cached_entry)
+
+    async def get_grm_contents(self, train_type):
+        if not train_type:
+            return {}
+
+        grm_ids = self._grm_ids(train_type)
+        return dict(zip(grm_ids, await asyncio.gather(*(self.get_grm_content(grm_id) for grm_id in grm_ids))))
+
+    async def create_grm_map(self, train_type):
+        if not train_type:
+            return "<h3>The train is full</h3>"
+
+        return self.render_grm_map(train_type, await self.get_grm_contents(train_type))
+
+    async def create_seat_layout(self, train_type):
+        return self.seat_layout(train_type, await self.get_grm_contents(train_type))
+
+    async def create_html(self, availability):
+        return self.render_html(availability, await self.create_grm_map(availability.equipment_type))
+
+    async def create_layout_asset(self, train_type):
+        return self.render_layout_asset(train_type, await self.create_grm_map(train_type))
+
+    async def search_train(self, train_number):
+        return self._check_schedule(await self.retrieve_realtime(train_number))
+
+    async def scan_hop(self, train_schedule, hop_index, fare_probing=False):
+        started = time.monotonic()
+        await self.clear_session()
+        segment_info = await self.get_available_trains(*self._hop_query(train_schedule, hop_index))
+
+        probe = FareProbe(segment_info[1], fare_probing)
+        for fare_sell_key in probe:
+            try:
+                if await self.hold_booking(segment_info[0], fare_sell_key):
+                    probe.add(await self.get_seat_availability(segment_info[0]))
+
+            except InvalidSessionError:
+                await self.get_session()
+                if await self.hold_booking(segment_info[0], fare_sell_key):
+                    probe.add(await self.get_seat_availability(segment_info[0]))
+
+        return self._hop_result(train_schedule, hop_index, segment_info[0], probe, started)
+
+    async def iter_seats(self, train_schedule, concurrency=1, fare_probing=False, hops=None):
+        hop_indexes = self._hop_indexes(train_schedule, hops)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def scan(hop_index):
+            started = time.monotonic()
+            try:
+                async with semaphore, self._lease_worker(concurrency) as worker:
+                    return await worker.scan_hop(train_schedule, hop_index, fare_probing)
+
+            except ItaloError as error:
+                return self._failed_hop_result(train_schedule, hop_index, error, started)
+
+        tasks = [asyncio.ensure_future(scan(hop_index)) for hop_index in hop_indexes]
+        try:
+            for next_task in asyncio.as_completed(tasks):
+                yield await next_task
+
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def search_seats(self, train_schedule, concurrency=1, fare_probing=False):
+        return SeatAvailability.from_hops(train_schedule, [hop_result async for hop_result in self.iter_seats(
+            train_schedule, concurrency, fare_probing)])
+
+    async def watch(self, train_number, interval=datetime.timedelta(minutes=5), concurrency=1, fare_probing=False):
+        hop_results = {}
+        availability = None
+        while True:
+            train_schedule = await self.search_train(train_number)
+            scanned_hops = self._pending_hops(train_schedule)
+            if not scanned_hops:
+                return
+
+            async for hop_result in self.iter_seats(train_schedule, concurrency, fare_probing, scanned_hops):
+                self._keep_hop_result(hop_results, hop_result)
+
+            availability, poll = self._watch_poll(train_schedule, hop_results, scanned_hops, availability)
+            yield availability, poll
+            await asyncio.sleep(interval.total_seconds())
+
+    async def close(self):
+        if self._own_session:
+            await self.session.aclose()
+
+        if self._own_session_pool:
+            await self.session_pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+def scan_to_files(tm, train_schedule, output_dir=".", split=False, write_json=False, concurrency=1,
+                  fare_probing=False, on_hop=None, journey=None, group_size=None, history=None):
+    """Scan the seats of a train and write its page (and JSON) into output_dir.
+
+    A `journey`, a (from station, to station) pair, scans only its hops (the others are marked as not scanned) and adds
+    its seats to the summary (see SeatAvailability.find_seats). With a `group_size`, it lists the most compact "groups"
+    of adjacent seats free for the journey too (see SeatLayout.find_groups). The scan is recorded into `history`, an
+    AvailabilityStore, when given.
+    `on_hop(hop_results)` is called every time a hop is scanned. Returns a summary of the scan, listing the
+    "unknown_hops" that couldn't be scanned (ItaloError when none could).
+    """
+    # fails before scanning when the train doesn't serve the stations
+    hops = journey_hops(train_schedule["StazioniNonFerme"], *journey) if journey else None
+    started = time.monotonic()
+    hop_results = []
+    for hop_result in tm.iter_seats(train_schedule, concurrency=concurrency, fare_probing=fare_probing, hops=hops):
+        hop_results.append(hop_result)
+        if on_hop:
+            on_hop(hop_results)
+
+    availability = SeatAvailability.from_hops(train_schedule, hop_results)
+    scanned_hops = [hop for hop in range(len(availability.hops)) if availability.is_scanned(hop)]
+    unknown_hops = [hop for hop in scanned_hops if availability.is_unknown(hop)]
+    if len(unknown_hops) == len(scanned_hops):
+        raise ItaloError("No hop scanned (%s)" % availability.hops[scanned_hops[0]]["error"])
+
+    if history:
+        history.record(availability)
+
+    os.makedirs(output_dir, exist_ok=True)
+    if split:
+        asset_name, asset_js = tm.create_layout_asset(availability.equipment_type)
+        if not os.path.exists(os.path.join(output_dir, asset_name)):
+            with open(os.path.join(output_dir, asset_name), "w") as file:
+                file.write(asset_js)
+
+        page_html = tm.render_page_shell(availability, asset_name)
+
+    else:
+        page_html = tm.create_html(availability)
+
+    files = [os.path.abspath(os.path.join(output_dir, "italo_%s.html" % availability.train_number))]
+    with open(files[-1], "w") as file:
+        file.write(page_html)
+
+    if write_json:
+        files.append(os.path.abspath(os.path.join(output_dir, "italo_%s.json" % availability.train_number)))
+        with open(files[-1], "w") as file:
+            json.dump(availability.to_json(), file)
+
+    return {
+        "train_number": availability.train_number,
+        "equipment_type": availability.equipment_type,
+        "free_seats": [len(availability.free_seats(hop)) if hop in scanned_hops else None
+                       for hop in range(len(availability.hops))],
+        "free_for_journey": len(availability.free_between(hops.start, hops.stop) if journey else
+                                availability.free_for_journey()),
+        "scanned_hops": scanned_hops,
+        "unknown_hops": unknown_hops,
+        "journey": availability.find_seats(*journey) if journey else None,
+        "groups": tm.create_seat_layout(availability.equipment_type).find_groups(
+            availability, group_size, *journey or (), limit=10) if group_size else None,
+        "files": files,
+        "elapsed": time.monotonic() - started
+    }
+
+
+def scan_batch(train_numbers, concurrency=4, hop_concurrency=1, base_url=None, on_request=None, http2=False,
+               **scan_kwargs):
+    """Scan many trains in one process, at most `concurrency` at a time.
+
+    The trains share the anonymous sessions, the HTTP connections and the layout cache. Yields the summary of every
+    train (see scan_to_files) as soon as it's done, with the "error" of the trains that couldn't be scanned.
+    """
+    # each train may fetch its layouts while the others scan: on HTTP/2 the workers share the same connections too
+    session = http_session(pool_size=concurrency * POOL_SIZE, http2=http2)
+    # trains of the same corridor share their GetAvailableTrains answers
+    availability_cache = AvailabilityCache()
+    session_pool = SessionPool(lambda: TrainManager(grm_cache=False, session=session if http2 else None,
+                                                    base_url=base_url, on_request=on_request, http2=http2,
+                                                    availability_cache=availability_cache),
+                               size=concurrency * hop_concurrency)
+    grm_cache = GRMCache()
+    tm = TrainManager(grm_cache=grm_cache, session_pool=session_pool, session=session, base_url=base_url,
+                      on_request=on_request, http2=http2, availability_cache=availability_cache)
+
+    def scan(train_number):
+        try:
+            return scan_to_files(tm, tm.search_train(train_number), concurrency=hop_concurrency, **scan_kwargs)
+
+        except (ItaloError, UserError) as error:
+            return {"train_number": train_number, "error": str(error)}
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in concurrent.futures.as_completed([executor.submit(scan, train_number)
+                                                           for train_number in train_numbers]):
+                yield future.result()
+
+    finally:
+        session_pool.close()
+        session.close()
+
+
+class FleetScheduler:
+    """Scan a roster of trains over and over until they depart, the soonest departures most often.
+
+    A train is due again `refresh` times the time left before its next departure after each scan (between
+    min_interval and max_interval), and only its hops still to depart are scanned. Due trains are scanned by
+    `concurrency` workers, the soonest departure first when several are late, and every request draws from a global
+    `rate` (requests per second, see TokenBucket). Iterate run() to get (availability, report) after every scan,
+    availability being None when it failed; stats() sums up the work done so far.
+    """
+
+    def __init__(self, train_numbers, concurrency=4, rate=5.0, burst=10, refresh=0.1,
+                 min_interval=datetime.timedelta(minutes=5), max_interval=datetime.timedelta(hours=2),
+                 fare_probing=True, history=None, base_url=None, on_request=None):
+        self.concurrency = concurrency
+        self.refresh = refresh
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.fare_probing = fare_probing
+        self.history = history
+        self.on_request = on_request
+
+        # (due time, departure time, order, train number): every train is due at once at the start, its departure
+        # unknown until its first scan
+        self._queue = [(time.time(), 0, index, str(train_number)) for index, train_number in enumerate(train_numbers)]
+        heapq.heapify(self._queue)
+        # due trains waiting for a worker, as (departure time, due time, order, train number)
+        self._late = []
+        self._order = len(self._queue)
+        self._stop = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = {"scans": 0, "failed": 0, "requests": 0, "departed": 0, "skipped": 0, "lag": 0.0,
+                       "max_lag": 0.0, "started": time.monotonic()}
+
+        availability_cache = AvailabilityCache()
+        rate_limit = TokenBucket(rate, burst)
+        self.session_pool = SessionPool(lambda: TrainManager(grm_cache=False, base_url=base_url,
+                                                             on_request=self._record_request,
+                                                             availability_cache=availability_cache,
+                                                             rate_limit=rate_limit),
+                                        size=concurrency)
+        # the manager doesn't close a session it's given: run() does
+        self.session = http_session(concurrency * POOL_SIZE)
+        self.tm = TrainManager(grm_cache=False, session_pool=self.session_pool, session=self.session,
+                               base_url=base_url, on_request=self._record_request,
+                               availability_cache=availability_cache, rate_limit=rate_limit)
+
+    def _record_request(self, event):
+        with self._stats_lock:
+            self._stats["requests"] += 1
+
+        if self.on_request:
+            self.on_request(event)
+
+    def _interval(self, departure):
+        interval = datetime.timedelta(seconds=self.refresh * max(0.0, departure - time.time()))
+        return min(self.max_interval, max(self.min_interval, interval)).total_seconds()
+
+    def _scan(self, train_number, due):
+        started = time.time()
+        report = {"train_number": train_number, "time": datetime.datetime.now().isoformat(timespec="seconds"),
+                  "lag": max(0.0, started - due), "hops": [], "error": None}
+        try:
+            train_schedule = self.tm.search_train(train_number)
+            hops = self.tm._pending_hops(train_schedule)
+            if not hops:
+                report["next"] = None
+                return None, report
+
+            hop_results = list(self.tm.iter_seats(train_schedule, fare_probing=self.fare_probing, hops=hops))
+            availability = SeatAvailability.from_hops(train_schedule, hop_results)
+            if self.history:
+                self.history.record(availability)
+
+            departure = departure_datetime(train_schedule["StazioniNonFerme"][hops[0]]["EstimatedArrivalTime"])
+            report.update(hops=hops, departure=departure.timestamp(),
+                          unknown_hops=[hop for hop in hops if availability.is_unknown(hop)],
+                          free=[len(availability.free_seats(hop)) for hop in hops])
+            report["interval"] = self._interval(report["departure"])
+            report["next"] = started + report["interval"]
+            return availability, report
+
+        except (ItaloError, UserError) as error:
+            # e.g. a train not running today: try again later
+            report.update(error=str(error), departure=0, interval=self.max_interval.total_seconds())
+            report["next"] = started + report["interval"]
+            return None, report
+
+        finally:
+            report["elapsed"] = time.time() - started
+
+    def _account(self, availability, report, interval):
+        with self._stats_lock:
+            self._stats["scans"] += 1
+            self._stats["failed"] += bool(report["error"])
+            self._stats["departed"] += report["next"] is None
+            self._stats["lag"] += report["lag"]
+            self._stats["max_lag"] = max(self._stats["max_lag"], report["lag"])
+            # refreshes that should have happened while the train waited in the queue
+            self._stats["skipped"] += int(report["lag"] // interval) if interval else 0
+
+    def run(self):
+        intervals = {}
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                running = {}
+                while not self._stop.is_set() and (self._queue or self._late or running):
+                    while self._queue and self._queue[0][0] <= time.time():
+                        due, departure, order, train_number = heapq.heappop(self._queue)
+                        heapq.heappush(self._late, (departure, due, order, train_number))
+
+                    while self._late and len(running) < self.concurrency:
+                        _, due, _, train_number = heapq.heappop(self._late)
+                        running[executor.submit(self._scan, train_number, due)] = train_number
+
+                    if not running:
+                        self._stop.wait(self._queue[0][0] - time.time())
                         continue
 
-                    if not self.train_type:
-                        self.train_type = seats["Equipment"]["EquipmentType"]
+                    timeout = max(0.0, self._queue[0][0] - time.time()) \
+                        if self._queue and len(running) < self.concurrency else None
+                    done, _ = concurrent.futures.wait(running, timeout, concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        del running[future]
+                        availability, report = future.result()
+                        # the lag of a scan is measured against the interval it was queued with
+                        self._account(availability, report, intervals.get(report["train_number"]))
+                        if report["next"] is not None:
+                            intervals[report["train_number"]] = report["interval"]
+                            # failed scans don't know the departure: they wait behind the known ones
+                            heapq.heappush(self._queue, (report["next"], report["departure"] or math.inf,
+                                                         self._order, report["train_number"]))
+                            self._order += 1
+
+                        yield availability, report
+
+        finally:
+            self.stop()
+            self.tm.close()
+            self.session.close()
+            self.session_pool.close()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        """Throughput (scans per minute, requests per second), queue lag (seconds a due scan waited) and skipped work"""
+        with self._stats_lock:
+            elapsed = time.monotonic() - self._stats["started"]
+            return {"scans": self._stats["scans"], "failed": self._stats["failed"],
+                    "departed": self._stats["departed"], "queued": len(self._queue) + len(self._late),
+                    "scans_per_minute": 60 * self._stats["scans"] / elapsed if elapsed else 0.0,
+                    "requests_per_second": self._stats["requests"] / elapsed if elapsed else 0.0,
+                    "mean_lag": self._stats["lag"] / self._stats["scans"] if self._stats["scans"] else 0.0,
+                    "max_lag": self._stats["max_lag"], "skipped_refreshes": self._stats["skipped"]}
+
+
+def http_session(pool_size=POOL_SIZE, http2=False, session=None):
+    """HTTP client of TrainManager: keeps up to `pool_size` connections alive per host and asks for compressed answers
+    (the seat maps are large JSON documents). It tunes `session` when given a requests.Session.
+
+    With http2 it's an httpx.Client (it requires httpx[http2]), multiplexing the requests on one connection per host.
+    """
+    if http2:
+        return _httpx_client(httpx.Client if httpx else None, pool_size, http2)
+
+    session = session or requests.Session()
+    # failed requests are retried by the managers (see BaseTrainManager.RETRIES), not by the adapter
+    adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    return session
+
+
+def async_http_session(pool_size=POOL_SIZE, http2=False):
+    """HTTP client of AsyncTrainManager, see http_session"""
+    return _httpx_client(httpx.AsyncClient if httpx else None, pool_size, http2)
+
+
+def _httpx_client(client_type, pool_size, http2):
+    if client_type is None:
+        raise ItaloError("HTTP/2 requires httpx")
+
+    try:
+        return client_type(http2=http2, limits=httpx.Limits(max_keepalive_connections=pool_size),
+                           headers={"Accept-Encoding": "gzip, deflate"})
+
+    except ImportError:
+        raise ItaloError("HTTP/2 requires httpx[http2]")
+
+
+def parse_grm_geometry(grm_svg):
+    """Position of every seat (`<a class="seat">` anchor, by its href) of a GRM layout, in the SVG coordinates.
+
+    A seat is placed at its first shape: the centre of a rect, circle or ellipse, the start of a path, or a text, moved
+    by the translations of the elements around it.
+    """
+    try:
+        root = xml.etree.ElementTree.fromstring(grm_svg)
 
-                    # print(seats["Equipment"]["AvailableUnits"])
-                    segment_seats.update([comp["CompartmentDesignator"] + "_" + seat["SeatDesignator"]
-                                          for comp in seats["Equipment"]["Compartments"]
-                                          for seat in comp["Seats"]
-                                          if seat["Assignable"] and seat["SeatAvailability"] == 5])
+    except xml.etree.ElementTree.ParseError:
+        raise ItaloError("Invalid GRM layout")
 
-            segments.append({
-                "name": self.train_schedule["StazioniNonFerme"][hop_index - 1]["LocationDescription"] + " ➔ " +
-                        self.train_schedule["StazioniNonFerme"][hop_index]["LocationDescription"],
-                "code": segment_info[0],
-                "seats": list(segment_seats)
-            })
-            # print(segment_info[0], len(segment_seats))
+    positions = {}
 
-        return self.create_html(segments)
+    def walk(element, offset, seat=None):
+        offset = _translate(offset, element.get("transform"))
+        tag = element.tag.rsplit("}", 1)[-1]
+        if tag == "a" and "seat" in element.get("class", "").split():
+            seat = element.get("href") or element.get("{http://www.w3.org/1999/xlink}href")
+
+        elif seat and seat not in positions:
+            position = _shape_position(tag, element)
+            if position:
+                positions[seat] = (position[0] + offset[0], position[1] + offset[1])
+
+        for child in element:
+            walk(child, offset, seat)
+
+    walk(root, (0.0, 0.0))
+    return positions
+
+
+def _translate(offset, transform):
+    # only the translation of a transform is kept: the seats of a layout aren't rotated or scaled one by one
+    match = re.search(r"(translate|matrix)\(([^)]*)\)", transform or "")
+    if not match:
+        return offset
+
+    values = [float(value) for value in re.split(r"[\s,]+", match.group(2).strip())]
+    x, y = values[-2:] if match.group(1) == "matrix" else (values + [0.0])[:2]
+    return offset[0] + x, offset[1] + y
+
+
+def _shape_position(tag, element):
+    try:
+        if tag == "rect":
+            return (float(element.get("x", 0)) + float(element.get("width", 0)) / 2,
+                    float(element.get("y", 0)) + float(element.get("height", 0)) / 2)
+
+        elif tag in ("circle", "ellipse"):
+            return float(element.get("cx", 0)), float(element.get("cy", 0))
+
+        elif tag == "path":
+            # the first point of a path is absolute, even after a relative moveto
+            x, y = re.findall(r"-?(?:\d+\.?\d*|\.\d+)(?:e-?\d+)?", element.get("d", ""))[:2]
+            return float(x), float(y)
+
+        elif tag == "text":
+            return float(element.get("x", 0)), float(element.get("y", 0))
+
+    except ValueError:
+        return None
+
+    return None
+
+
+def stop_index(stops, station):
+    """Index in stops (StazioniNonFerme) of a station, by LocationCode or LocationDescription (case insensitive)"""
+    for index, stop in enumerate(stops):
+        if station.casefold() in (stop["LocationCode"].casefold(), stop["LocationDescription"].casefold()):
+            return index
+
+    raise UserError("The train doesn't stop at %s" % station)
+
+
+def journey_hops(stops, from_station, to_station):
+    """Hops (a range of indexes) travelled from a stop to another, by LocationCode or LocationDescription"""
+    from_stop, to_stop = stop_index(stops, from_station), stop_index(stops, to_station)
+    if from_stop >= to_stop:
+        raise UserError("The train stops at %s after %s" % (stops[from_stop]["LocationDescription"],
+                                                            stops[to_stop]["LocationDescription"]))
+
+    return range(from_stop, to_stop)
+
+
+def natural_key(text):
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", text)]
+
+
+def departure_datetime(time_str):
+    return datetime.datetime.combine(datetime.date.today(), datetime.time.fromisoformat(time_str))
 
 
 def convert_departure_timestamp(time_str):
-    datetime_obj = datetime.datetime.combine(datetime.date.today(), datetime.time.fromisoformat(time_str))
+    datetime_obj = departure_datetime(time_str)
     interval_start_unix = int((datetime_obj - datetime.timedelta(hours=1)).timestamp()) * 1000
     interval_end_unix = int((datetime_obj + datetime.timedelta(hours=2)).timestamp()) * 1000
     return "/Date(%s)/" % interval_start_unix, "/Date(%s)/" % interval_end_unix
+
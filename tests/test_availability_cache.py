@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+import fake_italo
+from italo import AsyncAvailabilityCache, AsyncTrainManager, AvailabilityCache, ItaloError, TrainManager
+
+
+class UnlistedTrainItalo(fake_italo.FakeItalo):
+    """FakeItalo whose GetAvailableTrains answers leave out `unlisted` (the realtime schedule still has it)"""
+
+    def __init__(self, unlisted, **kwargs):
+        super().__init__(**kwargs)
+        self.unlisted = unlisted
+
+    def _GetAvailableTrains(self, payload, session):
+        answer = super()._GetAvailableTrains(payload, session)
+        answer["JourneyDateMarkets"][0]["Journeys"] = [
+            journey for journey in answer["JourneyDateMarkets"][0]["Journeys"]
+            if journey["JourneySellKey"].split("~")[1] != self.unlisted]
+        return answer
+
+
+JOURNEYS = [("IT~9921~ ~~SMN~RMT~", [])]
+
+
+def test_train_not_in_the_answer():
+    cache = AvailabilityCache()
+    with pytest.raises(ItaloError):
+        cache.get(("SMN", "RMT"), ("06:00", "07:00"), 8918, lambda: JOURNEYS)
+
+    assert not cache._pending
+    assert cache.get(("SMN", "RMT"), ("06:00", "07:00"), 9921, lambda: []) == JOURNEYS[0]
+
+
+def test_async_train_not_in_the_answer():
+    async def fetch():
+        return JOURNEYS
+
+    async def scenario():
+        cache = AsyncAvailabilityCache()
+        with pytest.raises(ItaloError):
+            await cache.get(("SMN", "RMT"), ("06:00", "07:00"), 8918, fetch)
+
+        assert not cache._pending
+
+    asyncio.run(scenario())
+
+
+def test_unlisted_train_fails_its_hops_only():
+    with UnlistedTrainItalo("8918") as server, TrainManager(base_url=server.url) as manager:
+        availability = manager.search_seats(manager.search_train(8918), concurrency=4)
+
+    assert all(availability.is_unknown(hop) for hop in range(len(availability.hops)))
+    assert all(hop["error"].startswith("ItaloError") for hop in availability.hops)
+
+
+def test_async_unlisted_train_fails_its_hops_only():
+    async def scenario():
+        manager = AsyncTrainManager(base_url=server.url)
+        try:
+            return await manager.search_seats(await manager.search_train(8918), concurrency=4)
+
+        finally:
+            await manager.close()
+
+    with UnlistedTrainItalo("8918") as server:
+        availability = asyncio.run(scenario())
+
+    assert all(hop["error"].startswith("ItaloError") for hop in availability.hops)
+
+
+def test_cancelled_corridor_lookup_is_retried_by_its_waiters():
+    async def scenario():
+        started = asyncio.Event()
+
+        async def slow_fetch():
+            started.set()
+            await asyncio.sleep(0.1)
+            return JOURNEYS
+
+        async def fetch():
+            return JOURNEYS
+
+        cache = AsyncAvailabilityCache()
+        owner = asyncio.create_task(cache.get(("SMN", "RMT"), ("06:00", "07:00"), 8918, slow_fetch))
+        await started.wait()
+        waiter = asyncio.create_task(cache.get(("SMN", "RMT"), ("06:00", "07:00"), 9921, fetch))
+        await asyncio.sleep(0)
+        owner.cancel()
+        return await waiter
+
+    assert asyncio.run(scenario()) == JOURNEYS[0]
@@ -0,0 +1,25 @@
+import fake_italo
+from italo import TrainManager
+
+
+def sold_out_smart_fixtures(train_number="9921"):
+    """Fixtures where the Smart compartments of `train_number` are fully busy on every hop"""
+    fixtures = fake_italo.build_fixtures()
+    train = fixtures["trains"][train_number]
+    compartment_classes = fake_italo.COMPARTMENT_CLASSES[train["equipment_type"]]
+    train["hops"] = [[seat for seat in hop if compartment_classes.get(seat.split("_")[0], "S") != "S"]
+                     for hop in train["hops"]]
+    return fixtures
+
+
+def free_seats(fare_probing):
+    with fake_italo.FakeItalo(sold_out_smart_fixtures()) as server, TrainManager(base_url=server.url) as manager:
+        availability = manager.search_seats(manager.search_train(9921), fare_probing=fare_probing)
+
+    return [len(availability.free_seats(hop)) for hop in range(len(availability.hops))]
+
+
+def test_sold_out_class_doesnt_hide_the_others():
+    exhaustive = free_seats(fare_probing=False)
+    assert all(exhaustive)
+    assert free_seats(fare_probing=True) == exhaustive
@@ -0,0 +1,24 @@
+import heapq
+import time
+
+from italo import FleetScheduler
+
+
+class RecordingScheduler(FleetScheduler):
+    """FleetScheduler whose scans only record the trains, that depart right after"""
+
+    def _scan(self, train_number, due):
+        return None, {"train_number": train_number, "lag": time.time() - due, "error": None, "next": None}
+
+
+def test_late_trains_are_scanned_soonest_departure_first():
+    scheduler = RecordingScheduler([], concurrency=1, base_url="http://127.0.0.1:9")
+    now = time.time()
+    # 8918 is the most overdue but leaves last
+    for order, (due, departure, train_number) in enumerate(((now - 300, now + 7200, "8918"),
+                                                           (now - 200, now + 600, "9921"),
+                                                           (now - 100, now + 3600, "8158"))):
+        heapq.heappush(scheduler._queue, (due, departure, order, train_number))
+
+    assert [report["train_number"] for _, report in scheduler.run()] == ["9921", "8158", "8918"]
+    assert scheduler.stats()["departed"] == 3
@@ -0,0 +1,34 @@
+import os
+import builtins
+import symtable
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# raspone_module/italo.py can't be imported without the bot (telegram, modules, src): check its names statically
+MODULES = ("italo.py", "fake_italo.py", "bench_italo.py", os.path.join("raspone_module", "italo.py"))
+
+
+def undefined_globals(source, filename):
+    """Global names read somewhere in `source` but never imported, assigned or defined at module level"""
+    table = symtable.symtable(source, filename, "exec")
+    defined = {symbol.get_name() for symbol in table.get_symbols() if symbol.is_assigned() or symbol.is_imported()}
+    defined |= set(dir(builtins)) | {"__file__"}
+
+    undefined = set()
+    scopes = [table]
+    while scopes:
+        scope = scopes.pop()
+        undefined.update(symbol.get_name() for symbol in scope.get_symbols()
+                         if symbol.is_referenced() and (scope is table or symbol.is_global())
+                         and symbol.get_name() not in defined)
+        scopes.extend(scope.get_children())
+
+    return undefined
+
+
+@pytest.mark.parametrize("path", MODULES)
+def test_module_imports_what_it_uses(path):
+    with open(os.path.join(ROOT, path)) as file:
+        assert undefined_globals(file.read(), path) == set()
@@ -0,0 +1,48 @@
+import asyncio
+
+import fake_italo
+from italo import AsyncTrainManager, TrainManager
+
+
+class CorruptSeatMapItalo(fake_italo.FakeItalo):
+    """FakeItalo whose GetSeatAvailability answers claim to be gzipped but aren't"""
+
+    def _handler(self):
+        handler = super()._handler()
+
+        class CorruptHandler(handler):
+            def _reply(self, response):
+                if not self.path.endswith("GetSeatAvailability"):
+                    return super()._reply(response)
+
+                body = b"not gzip"
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return CorruptHandler
+
+
+def test_undecodable_answer_fails_its_hop_only():
+    with CorruptSeatMapItalo() as server, TrainManager(base_url=server.url) as manager:
+        availability = manager.search_seats(manager.search_train(9921), concurrency=2)
+
+    assert all(hop["error"].startswith("UnavailableError") for hop in availability.hops)
+
+
+def test_async_undecodable_answer_fails_its_hop_only():
+    async def scenario():
+        manager = AsyncTrainManager(base_url=server.url)
+        try:
+            return await manager.search_seats(await manager.search_train(9921), concurrency=2)
+
+        finally:
+            await manager.close()
+
+    with CorruptSeatMapItalo() as server:
+        availability = asyncio.run(scenario())
+
+    assert all(hop["error"].startswith("UnavailableError") for hop in availability.hops)
@@ -0,0 +1,23 @@
+import asyncio
+
+from italo import AsyncScheduleCache
+
+
+def test_cancelled_lookup_is_retried_by_its_waiters():
+    async def scenario():
+        started = asyncio.Event()
+
+        async def fetch(train_number):
+            started.set()
+            await asyncio.sleep(0.1)
+            return {"TrainNumber": train_number}
+
+        cache = AsyncScheduleCache()
+        owner = asyncio.create_task(cache.get(8918, fetch))
+        await started.wait()
+        waiter = asyncio.create_task(cache.get(8918, fetch))
+        await asyncio.sleep(0)
+        owner.cancel()
+        return await waiter
+
+    assert asyncio.run(scenario()) == {"TrainNumber": "8918"}